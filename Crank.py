@@ -1,14 +1,28 @@
+import sys
+
+# --engine async runs on greenlets, which only switch on sockets, ssl and
+# threads that gevent patched before anything below imports them
+if __name__ == "__main__" and ("--engine=async" in sys.argv or
+                               ["--engine", "async"] in [sys.argv[i:i + 2] for i in range(len(sys.argv))]):
+    try:
+        from gevent import monkey
+    except ImportError:
+        sys.exit("--engine async needs gevent (sudo pip install gevent)")
+    monkey.patch_all()
+
 import argparse
+import datetime
 import uuid
-import keystoneclient.v2_0.client as ksclient
 import os
-import sys
 import time
 import traceback
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Queue
+from Queue import Empty
 from neutronclient.v2_0 import client as neutronclient
 from novaclient import client as nClient
 from random import shuffle
+from CrankAsync import AsyncCrank
+from ReHeatSession import get_session, list_images, list_neutron, list_servers
 
 """
 Crank is a command line tool that allows a user to create (image, flavor) pairs.
@@ -58,20 +72,30 @@ class Crank:
 
         # clients
         self.novaclient = None
-        self.keystoneclient = None
+        self.session = None
         self.neutronclient = None
 
         # other variables
         self.pairs = []
+        self.network_ids = []
         self.final_pair = None
         self.new_pair = True
-        self.max_process = 30
+        self.engine = args.engine
+        self.max_process = args.in_flight or 30
+        self.batch_size = args.batch_size
+        self.create_workers = 8
+        self.poll_interval = 5
+        self.max_retries = 5
+        self.boot_timeout = 600
+        self.retry_backoff = 2
+        self.run_id = None
+        self.changes_since = None
+        self.clock_skew = datetime.timedelta(minutes=1)
+        self.matched = set()
+        self.expired = set()
         self.master_list = []
         self.all_instances = []
-        self.post_instances = []
         self.delete_instances = []
-        self.manager = Manager()
-        self.return_list = self.manager.list()
 
     def run(self):
         tenant = self.gen_clients()
@@ -86,17 +110,11 @@ class Crank:
                 self.gen_availability_zone_pair()
                 self.gen_instance_count_pair()
             self.gen_instances()
-            self.go(self.all_instances)
-
-            # handle instances that came up as 'ERROR'
-            while len(self.return_list) > 0:
-
-                # return_list and all_instances
-                self.post_instances = [x for x in self.master_list if x["name"] in self.return_list]
-                self.return_list = self.manager.list()
-
-                print "\n\t* Re-Processing %s instances" % str(len(self.post_instances))
-                self.go(self.post_instances)
+            if self.engine == "async":
+                AsyncCrank(self, window=self.args.in_flight or 1000,
+                           boot_timeout=self.boot_timeout).go(self.all_instances)
+            else:
+                self.go(self.all_instances)
 
             # clean up the ones that are left errored
             self.finalize()
@@ -133,22 +151,32 @@ class Crank:
             sys.exit(1)
 
         print "\t* Connecting to keystone"
-        self.keystoneclient = ksclient.Client(**kcreds)
-        tokenlen = len(self.keystoneclient.auth_token)
+        self.session = get_session(**kcreds)
+        self.session.verify()
+        auth_token = self.session.auth_token
+        tokenlen = len(auth_token)
 
-        print "\t* AuthToken: " + self.keystoneclient.auth_token[0:20] + "..." + \
-              self.keystoneclient.auth_token[tokenlen-20:tokenlen]
+        print "\t* AuthToken: " + auth_token[0:20] + "..." + \
+              auth_token[tokenlen-20:tokenlen]
 
-        ncreds = self.get_nova_creds()
-        client = nClient.get_client_class('2')
-        self.novaclient = client(**ncreds)
+        self.novaclient = self.gen_nova_client()
 
-        network_url = self.keystoneclient.service_catalog.url_for(service_type='network')
+        network_url = self.session.url_for('network')
         self.neutronclient = neutronclient.Client(endpoint_url=network_url,
-                                                   token=self.keystoneclient.auth_token)
+                                                   token=auth_token)
 
         return kcreds["tenant_name"]
 
+    def gen_nova_client(self):
+        """ a nova client on the cached token, novaclient's HTTPClient (and
+            its requests session) is not safe to share between processes
+        """
+
+        client = nClient.get_client_class('2')
+        return client(auth_token=self.session.auth_token,
+                      bypass_url=self.session.url_for('compute'),
+                      **self.get_nova_creds())
+
     def gen_image_flavor_pair(self):
         """ """
 
@@ -157,7 +185,7 @@ class Crank:
 
         print "\n\t* Lets generate (image, flavor) pair"
 
-        images = self.novaclient.images.list(detailed=False)
+        images = list(list_images(self.novaclient, detailed=False))
         print "\t? What base image would you like to use? - expecting (int)"
         for idx, image in enumerate(images):
             print "\t [%s] - %s" % (str(idx), str(image.name))
@@ -190,12 +218,15 @@ class Crank:
         self.image_flavor = (images[selected_image], flavors[selected_flavor])
 
     def gen_network_instance_pair(self):
-        """ """
+        """ pick the networks of a pair, their ids are resolved here once so
+            booting never has to look them up in neutron
+        """
         netList = []
+        netIds = []
         newNet = True
         print "\n\t* Lets generate (network, (image, flavor)) pair"
-        networks = self.neutronclient.list_networks()['networks']
-        networks = [x for x in networks if x["name"] != "public" and x['tenant_id'] == self.keystoneclient.tenant_id]
+        networks = list_neutron(self.neutronclient.list_networks, "networks")
+        networks = [x for x in networks if x["name"] != "public" and x['tenant_id'] == self.session.tenant_id]
 
         while newNet is True:
             print "\t? What network would you like to use? - expecting (int)"
@@ -216,7 +247,9 @@ class Crank:
                 return networks[selected_network]["name"]
 
             netList.append(networks[selected_network]["name"])
+            netIds.append(networks[selected_network]["id"])
             self.network_image_flavor = (netList, self.image_flavor)
+            self.network_ids = netIds
 
             print "\n\t? Would you like to add a new net to this pair?"
             newNetOption = str(raw_input("\t>> [y/n]: "))
@@ -264,6 +297,7 @@ class Crank:
 
         self.final_pair = {"instance_count": instance_count,
                            "network": self.network_image_flavor[0],
+                           "network_ids": self.network_ids,
                            "image": self.network_image_flavor[1][0],
                            "flavor": self.network_image_flavor[1][1],
                            "availability_zone": self.az}
@@ -288,12 +322,14 @@ class Crank:
         self.confirmation()
         all_instances = []
 
-        for pair in self.pairs:
+        for pair_idx, pair in enumerate(self.pairs):
             for instance in range(pair["instance_count"]):
                 uniqName = "%s_%s_%s" %(pair["image"].name, pair["flavor"].name, str(instance))
                 new_instance = {
                     "name": uniqName,
+                    "pair": pair_idx,
                     "network": pair["network"],
+                    "network_ids": pair["network_ids"],
                     "image": pair["image"],
                     "flavor": pair["flavor"],
                     "availability_zone": pair["availability_zone"]
@@ -307,74 +343,256 @@ class Crank:
         self.master_list = list(all_instances)
 
     def go(self, instances):
-        """ """
-        while len(instances) > 0:
-            processes = []
-
-            for i in range(self.max_process):
-                if len(instances) == 0:
-                    break
-
-                mp = Process(target=self.create_instances, args=(instances.pop(), self.return_list,))
-                processes.append(mp)
-
-            [x.start() for x in processes]
-            [x.join(180) for x in processes]
-
-    def create_instances(self, new_instance, return_list):
-        """ """
-        listOfNics = []
-        nets = self.neutronclient.list_networks()["networks"]
-        for networkAttached in new_instance["network"]:
-            net = [network for network in nets if network["name"] == networkAttached]
-            listOfNics.append({"net-id": net[0]['id']})  # replaces net-id
+        """ keep max_process boots in flight: a pool of persistent workers
+            creates the instances in batches, a single poller watches all of
+            them. Instances nova refuses to create, that come up as 'ERROR' or
+            that are not up within boot_timeout seconds are retried with a
+            growing delay, up to max_retries times
+        """
+
+        # workers are forked with the plan, only indexes go over the queues
+        self.master_list = list(instances)
+        self.run_id = str(uuid.uuid4())
+        self.changes_since = self.watermark(datetime.datetime.utcnow())
+        self.matched = set()
+        self.expired = set()
+        tasks = Queue()
+        results = Queue()
+        workers = [Process(target=self.worker, args=(tasks, results))
+                   for i in range(min(self.create_workers, len(self.master_list)))]
+        [x.start() for x in workers]
+
+        queued = range(len(self.master_list))
+        queued.reverse()
+        creating = {}   # batch id -> indexes the workers are creating
+        batches = {}    # batch id -> indexes not matched to a server yet
+        in_flight = {}  # server id -> (batch id, index)
+        started = {}    # batch id -> time it was handed to the workers
+        failures = {}   # index -> failed creates and boots
+        delayed = []    # (retry time, index) of failed instances
+        batch_count = 0
+        pending = len(self.master_list)
+        try:
+            while pending > 0:
+                # failed instances whose backoff is over are queued again
+                for retry in [x for x in delayed if x[0] <= time.time()]:
+                    delayed.remove(retry)
+                    queued.append(retry[1])
+
+                # top up the window of in flight boots
+                room = self.max_process - len(in_flight) - \
+                    sum(map(len, creating.values())) - sum(map(len, batches.values()))
+                while len(queued) > 0 and room > 0:
+                    batch = self.next_batch(queued, min(room, self.batch_size))
+                    batch_id = "%s-%d" % (self.run_id[:8], batch_count)
+                    batch_count += 1
+                    creating[batch_id] = batch
+                    started[batch_id] = time.time()
+                    tasks.put((batch_id, batch))
+                    room -= len(batch)
+
+                # collect the batches the workers created until the next poll
+                deadline = time.time() + self.poll_interval
+                while len(creating) > 0:
+                    try:
+                        batch_id, created = results.get(timeout=max(0, deadline - time.time()))
+                    except Empty:
+                        break
+                    batch = creating.pop(batch_id, None)
+                    if batch is None:
+                        # timed out while it was created, see expire()
+                        continue
+                    if created:
+                        batches[batch_id] = batch
+                    else:
+                        for idx in batch:
+                            if not self.retry(idx, failures, delayed):
+                                pending -= 1
+                time.sleep(max(0, deadline - time.time()))
+
+                pending -= self.poll(batches, in_flight, failures, delayed)
+                pending -= self.expire(creating, batches, in_flight, started, failures, delayed)
+        finally:
+            # one sentinel per worker
+            [tasks.put(None) for x in workers]
+            [x.join() for x in workers]
+
+    def expire(self, creating, batches, in_flight, started, failures, delayed):
+        """ fail every boot that is not up boot_timeout seconds after its
+            batch went to the workers, returns how many ran out of retries
+        """
+
+        done = 0
+        deadline = time.time() - self.boot_timeout
+        for stage in (creating, batches):
+            for batch_id, batch in stage.items():
+                if started[batch_id] > deadline:
+                    continue
+                # servers of the batch that show up later are deleted
+                del stage[batch_id]
+                self.expired.add(batch_id)
+                for idx in batch:
+                    print "\t! %s was not created in %d seconds." % \
+                        (str(self.master_list[idx]["name"]), self.boot_timeout)
+                    if not self.retry(idx, failures, delayed):
+                        done += 1
+
+        for server_id, (batch_id, idx) in in_flight.items():
+            if started[batch_id] > deadline:
+                continue
+            del in_flight[server_id]
+            print "\t! %s did not leave BUILD in %d seconds." % \
+                (str(self.master_list[idx]["name"]), self.boot_timeout)
+            try:
+                self.novaclient.servers.delete(server_id)
+            except:
+                pass
+            if not self.retry(idx, failures, delayed):
+                done += 1
+        return done
+
+    def retry(self, idx, failures, delayed):
+        """ count a failed create or boot and schedule the instance again
+            after retry_backoff * 2^(failures - 1) seconds, returns False
+            once it ran out of retries
+        """
+
+        failures[idx] = failures.get(idx, 0) + 1
+        if failures[idx] > self.max_retries:
+            print "\t! Giving up on %s after %d failed attempts." % \
+                (str(self.master_list[idx]["name"]), failures[idx])
+            return False
+        delay = self.retry_backoff * 2 ** (failures[idx] - 1)
+        print "\t! Adding %s to be Re-Processed in %d seconds." % \
+            (str(self.master_list[idx]["name"]), delay)
+        delayed.append((time.time() + delay, idx))
+        return True
+
+    def next_batch(self, queued, size):
+        """ take up to size queued instances of the same pair """
+
+        batch = [queued.pop()]
+        pair = self.master_list[batch[0]]["pair"]
+        for idx in reversed(list(queued)):
+            if len(batch) >= size:
+                break
+            if self.master_list[idx]["pair"] == pair:
+                queued.remove(idx)
+                batch.append(idx)
+        return batch
+
+    def worker(self, tasks, results):
+        """ create batches from the task queue until the sentinel arrives """
+
+        # the parent keeps polling with its client after the fork
+        self.novaclient = self.gen_nova_client()
+        for batch_id, batch in iter(tasks.get, None):
+            results.put((batch_id, self.create_instances(batch_id, batch)))
+
+    def create_instances(self, batch_id, batch):
+        """ ask nova for a batch of identical instances with one multi-create
+            request tagged with this run and batch, returns whether it was accepted
+        """
+
+        new_instance = self.master_list[batch[0]]
+        listOfNics = [{"net-id": net_id} for net_id in new_instance["network_ids"]]
         try:
-            instance = self.novaclient.servers.create(new_instance["name"],
+            self.novaclient.servers.create(new_instance["name"],
                                         new_instance["image"],
                                         new_instance["flavor"],
                                         key_name="reheat_key",
                                         availability_zone=new_instance["availability_zone"],
-                                        nics=listOfNics
+                                        nics=listOfNics,
+                                        min_count=len(batch),
+                                        max_count=len(batch),
+                                        meta={"crank_run": self.run_id, "crank_batch": batch_id}
                  )
-        except:
+        except Exception as e:
             # could not process instance. We will send this to be reprocessed
-            pass
-        # Poll at 5 second intervals, until the status is no longer 'BUILD'
+            print "\t! Could not create %s: %s" % (str(new_instance["name"]), str(e))
+            return False
+        for idx in batch:
+            sys.stdout.write("\t* Building %s...\n" % str(self.master_list[idx]["name"]))
+        return True
+
+    def poll(self, batches, in_flight, failures, delayed):
+        """ look at every in flight boot of this run with one paginated detailed
+            listing and act on the ones that left 'BUILD', returns how many are done
+        """
+
+        done = 0
+        polled = datetime.datetime.utcnow()
         try:
+            servers = list(list_servers(self.novaclient, **{"changes-since": self.changes_since}))
+        except Exception as e:
+            print "\t! Could not poll instance status: %s" % str(e)
+            return done
+        # the next poll only needs what changed since this one
+        self.changes_since = self.watermark(polled)
+
+        for instance in servers:
+            if instance.metadata.get("crank_run") != self.run_id:
+                continue
+
+            # servers of a multi-create are matched to the planned instances
+            # of their batch as they show up
+            batch_id = instance.metadata.get("crank_batch")
+            batch = batches.get(batch_id)
+            if instance.id not in self.matched and batch:
+                self.matched.add(instance.id)
+                in_flight[instance.id] = (batch_id, batch.pop())
+                if len(batch) == 0:
+                    del batches[batch_id]
+            elif instance.id not in self.matched and batch_id in self.expired:
+                # a late server of a batch that timed out, it was retried
+                self.matched.add(instance.id)
+                try:
+                    instance.delete()
+                except:
+                    pass
+                continue
+            if instance.id not in in_flight:
+                continue
+
             status = instance.status
-        except:
-            status = "BUILD"
-            pass
-        sys.stdout.write("\t* Building %s...\n" % str(new_instance["name"]))
-        while status == 'BUILD':
-            time.sleep(5)
+            if status == 'BUILD':
+                continue
 
-            # Retrieve the instance again so the status field updates
-            try:
-                instance = self.novaclient.servers.get(instance.id)
-                status = instance.status
-            except:
-                status = "BUILD"
+            batch_id, idx = in_flight.pop(instance.id)
+            new_instance = self.master_list[idx]
+            if status == 'ACTIVE':
+                newname = new_instance["name"] + str(instance.id)[:8]
+                try:
+                    self.novaclient.servers.update(instance.id, name=newname)
+                except Exception as e:
+                    print "\t! Could not rename %s: %s" % (str(new_instance["name"]), str(e))
+                print "\t* status: %s is %s" % (newname, status)
+                done += 1
+            elif status == 'DELETED':
+                print "\t! Deleting %s." % str(new_instance["name"])
+                done += 1
+            else:
+                print "\t* status: %s is %s" % (new_instance["name"], status)
+                try:
+                    instance.delete()
+                except:
+                    pass
+                if not self.retry(idx, failures, delayed):
+                    done += 1
+        return done
 
-        newname = new_instance["name"] + str(instance.id)[:8]
-        self.novaclient.servers.update(instance.id, name=newname)
-        print "\t* status: %s is %s" % (newname, status)
+    def watermark(self, when):
+        """ changes-since value for a poll at when, early by clock_skew so
+            servers updated while it ran and a skewed nova clock are not missed
+        """
 
-        if status == 'DELETED':
-            print "\t! Deleting %s." % str(new_instance["name"])
-        elif status != 'ACTIVE':
-            try:
-                instance.delete()
-            except:
-                pass
-            return_list.append(new_instance["name"])
-            print "\t! Adding %s to be Re-Processed." % str(new_instance["name"])
+        return (when - self.clock_skew).strftime("%Y-%m-%dT%H:%M:%SZ")
 
     def remove_clients(self):
         """ """
 
         network_name = self.gen_network_instance_pair()
-        servers = self.novaclient.servers.list()
+        servers = list_servers(self.novaclient)
         instances = filter(lambda server: network_name in server.networks, servers)
         self.confirmation()
         print "\t* Deleting all client instances from this project on selected network."
@@ -387,7 +605,7 @@ class Crank:
 
         print "\t* Deleting all client instances from this project."
         self.confirmation()
-        instances = self.novaclient.servers.list()
+        instances = list(list_servers(self.novaclient))
         for idx, instance in enumerate(instances):
             print "\t* [%s] Deleting name: %s - hostId: %s " % (str(idx + 1), instance.name, instance.hostId)
             instance.delete()
@@ -401,7 +619,7 @@ class Crank:
 
     def finalize(self):
         """ """
-        servers = self.novaclient.servers.list()
+        servers = list_servers(self.novaclient)
         errored = [server for server in servers if server.status != 'ACTIVE']
         for bad_server in errored:
             try:
@@ -414,6 +632,13 @@ def main():
     parser = argparse.ArgumentParser(description='Crank: Generate Instances')
     parser.add_argument('-t', '--crank-type', default=None,
                         help='Crank mass creation or deletion: type - [create, delete, delete-all], (default: None)', required=True)
+    parser.add_argument('--engine', default='process', choices=['process', 'async'],
+                        help='boot with forked worker processes or with greenlets in a single \
+                        process [process, async], (default: process)')
+    parser.add_argument('--in-flight', default=None, type=int, dest="in_flight",
+                        help='boots in flight at once, (default: 30 for process, 1000 for async)')
+    parser.add_argument('--batch-size', default=1, type=int, dest="batch_size",
+                        help='instances of the same pair nova creates per request, (default: 1)')
     parser.add_argument('--webuser', default=None, dest="webuser",
                         help='If set, use web user')
     parser.add_argument('--webtenant', default=None, dest="webtenant",
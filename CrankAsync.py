@@ -0,0 +1,206 @@
+import datetime
+import json
+import sys
+import uuid
+from requests.adapters import HTTPAdapter
+from ReHeatSession import paginate
+
+# greenlets are optional, only the async engine needs them
+try:
+    import gevent
+    from gevent.event import AsyncResult
+    from gevent.pool import Pool
+except ImportError:
+    gevent = None
+
+"""
+CrankAsync is the single process engine of Crank (crank --engine async).
+
+Every planned instance is a greenlet that creates its server, waits for the
+central poller to see it leave 'BUILD' and then renames it or deletes and
+recreates it. All of them share one pooled keep-alive HTTP session that
+talks to the nova api directly with the token and compute endpoint of the
+ReHeatSession, so thousands of boots can be in flight without a process
+or a set of clients per instance.
+
+Python 2 has no asyncio, so the coroutines are gevent greenlets. Crank.py
+monkey patches the standard library for them before it imports anything
+else, see the top of that module.
+
+# Dependancies
+sudo pip install gevent requests
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["N/A"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson"
+__email__ = "mika.ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development"
+
+
+class AsyncCrank:
+
+    def __init__(self, crank, window=1000, connections=64, boot_timeout=600):
+        if gevent is None:
+            raise ImportError("--engine async needs gevent (sudo pip install gevent)")
+
+        # plan and session of the interactive Crank run
+        self.crank             = crank
+        self.session           = crank.session
+        self.master_list       = []
+        self.compute_url       = self.session.url_for('compute').rstrip("/")
+
+        # one pooled http session for every request
+        self.http              = self.session.http
+        self.http.mount(self.compute_url, HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+
+        # in flight boots
+        self.window            = window
+        self.poll_interval     = crank.poll_interval
+        self.boot_timeout      = boot_timeout
+        self.run_id            = None
+        self.changes_since     = None
+        self.waiting           = {}
+
+    def go(self, instances):
+        """ boot every instance as a greenlet, at most window at a time """
+
+        self.master_list = list(instances)
+        self.run_id = str(uuid.uuid4())
+        self.changes_since = self.crank.watermark(datetime.datetime.utcnow())
+
+        poller = gevent.spawn(self.poll_loop)
+        pool = Pool(self.window)
+        try:
+            for idx in range(len(self.master_list)):
+                pool.spawn(self.boot, idx)
+            pool.join()
+        finally:
+            poller.kill()
+
+    def request(self, method, path, body=None, params=None):
+        """ one nova api call over the shared session """
+
+        r = self.session.request(method, self.compute_url + path,
+                                 params=params,
+                                 data=json.dumps(body) if body is not None else None,
+                                 headers={"Content-Type": "application/json",
+                                          "Accept": "application/json"})
+        r.raise_for_status()
+        if r.content:
+            return r.json()
+        return None
+
+    def boot(self, idx):
+        """ create one instance until it comes up 'ACTIVE' (or was deleted),
+            failed creates, 'ERROR' boots and boots stuck in 'BUILD' for
+            boot_timeout seconds are retried with a growing delay up to
+            max_retries times
+        """
+
+        new_instance = self.master_list[idx]
+        failures = 0
+        while True:
+            server_id = self.create(idx)
+            if server_id is None:
+                failures += 1
+                if not self.backoff(new_instance, failures):
+                    return
+                continue
+
+            # the poller hands over the status once it left 'BUILD'
+            result = AsyncResult()
+            self.waiting[server_id] = result
+            try:
+                status = result.get(timeout=self.boot_timeout)
+            except gevent.Timeout:
+                self.waiting.pop(server_id, None)
+                print "\t! %s did not leave BUILD in %d seconds." % (str(new_instance["name"]), self.boot_timeout)
+                status = None
+
+            if status == 'ACTIVE':
+                newname = new_instance["name"] + str(server_id)[:8]
+                try:
+                    self.request("PUT", "/servers/%s" % server_id, {"server": {"name": newname}})
+                except Exception as e:
+                    print "\t! Could not rename %s: %s" % (str(new_instance["name"]), str(e))
+                print "\t* status: %s is %s" % (newname, status)
+                return
+            if status == 'DELETED':
+                print "\t! Deleting %s." % str(new_instance["name"])
+                return
+
+            if status is not None:
+                print "\t* status: %s is %s" % (new_instance["name"], status)
+            try:
+                self.request("DELETE", "/servers/%s" % server_id)
+            except:
+                pass
+            failures += 1
+            if not self.backoff(new_instance, failures):
+                return
+
+    def backoff(self, new_instance, failures):
+        """ wait retry_backoff * 2^(failures - 1) seconds before the next
+            attempt, False once the instance ran out of retries
+        """
+
+        if failures > self.crank.max_retries:
+            print "\t! Giving up on %s after %d failed attempts." % (str(new_instance["name"]), failures)
+            return False
+        delay = self.crank.retry_backoff * 2 ** (failures - 1)
+        print "\t! Adding %s to be Re-Processed in %d seconds." % (str(new_instance["name"]), delay)
+        gevent.sleep(delay)
+        return True
+
+    def create(self, idx):
+        """ POST one server tagged with this run, returns its id """
+
+        new_instance = self.master_list[idx]
+        server = {"name": new_instance["name"],
+                  "imageRef": new_instance["image"].id,
+                  "flavorRef": new_instance["flavor"].id,
+                  "key_name": "reheat_key",
+                  "networks": [{"uuid": net_id} for net_id in new_instance["network_ids"]],
+                  "metadata": {"crank_run": self.run_id, "crank_index": str(idx)}}
+        if new_instance["availability_zone"]:
+            server["availability_zone"] = new_instance["availability_zone"]
+        try:
+            server_id = self.request("POST", "/servers", {"server": server})["server"]["id"]
+        except Exception as e:
+            print "\t! Could not create %s: %s" % (str(new_instance["name"]), str(e))
+            return None
+        sys.stdout.write("\t* Building %s...\n" % str(new_instance["name"]))
+        return server_id
+
+    def poll_loop(self):
+        while True:
+            gevent.sleep(self.poll_interval)
+            if len(self.waiting) > 0:
+                self.poll()
+
+    def poll(self):
+        """ one paginated detailed listing for every waiting boot of this run """
+
+        def list_page(limit, marker):
+            params = {"changes-since": self.changes_since, "limit": limit}
+            if marker is not None:
+                params["marker"] = marker
+            return self.request("GET", "/servers/detail", params=params)["servers"]
+
+        polled = datetime.datetime.utcnow()
+        try:
+            servers = list(paginate(list_page))
+        except Exception as e:
+            print "\t! Could not poll instance status: %s" % str(e)
+            return
+        # the next poll only needs what changed since this one
+        self.changes_since = self.crank.watermark(polled)
+
+        for server in servers:
+            if (server.get("metadata") or {}).get("crank_run") != self.run_id:
+                continue
+            if server["id"] in self.waiting and server["status"] != 'BUILD':
+                self.waiting.pop(server["id"]).set(server["status"])
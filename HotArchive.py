@@ -0,0 +1,202 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from HotWriter import dump_template
+
+"""
+HotArchive keeps every template ReHeat generates in a content addressed
+store, so scheduled backups only cost the resources that changed.
+
+- Every parameter, resource and attached file is stored once as an object
+  named by the sha1 of its canonical json (objects/ab/cdef...)
+- Every run adds a small manifest (manifests/<time>-<name>.json) mapping
+  the names of the template to its objects
+- Any manifest can be turned back into the template it was taken from
+
+usage:
+    python HotArchive.py ARCHIVE --list
+    python HotArchive.py ARCHIVE --restore MANIFEST [--output FILE] [--format yaml|json]
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["Christopher Semon", "Nick Tsamis"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson, Nick Tsamis"
+__email__ = "Mika.Ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development (JK)"
+
+
+class HotArchive:
+
+    def __init__(self, directory):
+        self.directory         = directory
+        self.objects_dir       = os.path.join(directory, "objects")
+        self.manifests_dir     = os.path.join(directory, "manifests")
+        self.new_objects       = 0
+
+        # mkstemp files are 0600, archived files get the mode open() would give
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode         = 0666 & ~umask
+
+    def digest(self, data):
+        """ sha1 of the canonical json of data """
+
+        return hashlib.sha1(self.canonical(data)).hexdigest()
+
+    def canonical(self, data):
+        return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def put(self, data):
+        """ store data unless an identical object exists, returns its digest """
+
+        digest = self.digest(data)
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest
+
+        self.write_atomic(path, self.canonical(data), compress=True)
+        self.new_objects += 1
+        return digest
+
+    def get(self, digest):
+        with gzip.open(self.object_path(digest), "rb") as f:
+            return json.loads(f.read())
+
+    def store(self, name, template, files=None, **info):
+        """ archive a template and the files it attaches, returns the manifest path """
+
+        self.new_objects = 0
+        manifest = {"name": name,
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "info": info,
+                    "template": {},
+                    "files": {}}
+
+        # sections are archived entry by entry, everything else is kept as is
+        for key, value in template.items():
+            if key in ("parameters", "resources") and isinstance(value, dict):
+                manifest["template"][key] = dict((entry, self.put(data)) for entry, data in value.items())
+            else:
+                manifest["template"][key] = value
+        for filename, text in (files or {}).items():
+            manifest["files"][filename] = self.put(text)
+
+        path = os.path.join(self.manifests_dir, "%s-%s.json" % (time.strftime("%Y%m%dT%H%M%S"), name))
+        idx = 1
+        while os.path.exists(path):
+            path = os.path.join(self.manifests_dir, "%s-%s.%d.json" % (time.strftime("%Y%m%dT%H%M%S"), name, idx))
+            idx += 1
+        self.write_atomic(path, json.dumps(manifest, sort_keys=True, indent=2))
+
+        entries = len(manifest["template"].get("resources", {})) + len(manifest["template"].get("parameters", {}))
+        print "\t* Archived %s (%d entries, %d new objects) in %s" % (name, entries, self.new_objects, path)
+        return path
+
+    def restore(self, manifest_path):
+        """ rebuild (name, template, files) from a manifest """
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        # the name becomes the default output file, it must not point elsewhere
+        name = manifest["name"]
+        if name in ("", ".", "..") or name != os.path.basename(name.replace("\\", "/")):
+            raise ValueError("manifest %s has an unsafe name %s" % (manifest_path, name))
+
+        template = {}
+        for key, value in manifest["template"].items():
+            if key in ("parameters", "resources") and isinstance(value, dict):
+                template[key] = dict((entry, self.get(digest)) for entry, digest in value.items())
+            else:
+                template[key] = value
+        files = {}
+        for filename, digest in manifest["files"].items():
+            # files are written next to the restored template, never elsewhere
+            if os.path.isabs(filename) or ".." in filename.replace("\\", "/").split("/"):
+                raise ValueError("manifest %s has an unsafe file name %s" % (manifest_path, filename))
+            files[filename] = self.get(digest)
+        return name, template, files
+
+    def manifests(self):
+        """ all manifests, oldest first """
+
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        return [os.path.join(self.manifests_dir, name) for name in sorted(os.listdir(self.manifests_dir))]
+
+    def write_atomic(self, path, text, compress=False):
+        """ write through a temporary file so readers never see partial objects """
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by a concurrent run
+                pass
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                os.fchmod(f.fileno(), self.file_mode)
+                if compress:
+                    with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                        gz.write(text)
+                else:
+                    f.write(text)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ReHEAT: list and restore archived templates')
+    parser.add_argument('archive', help='archive directory written by ReHeat --archive')
+    parser.add_argument('--list', default=False, action='store_true',
+                         help='If set, list the manifests in the archive')
+    parser.add_argument('--restore', default=None,
+                         help='manifest to rebuild the template from')
+    parser.add_argument('--output', default=None,
+                         help='file to write the restored template to, (default: <name>.<format>)')
+    parser.add_argument('--format', default='yaml', choices=['yaml', 'json'],
+                         help='restored template format [yaml, json], (default: yaml)')
+    args = parser.parse_args()
+
+    archive = HotArchive(args.archive)
+    if args.list:
+        for manifest in archive.manifests():
+            print manifest
+
+    if args.restore:
+        try:
+            name, template, files = archive.restore(args.restore)
+        except ValueError as e:
+            print "\t! Could not restore %s: %s" % (args.restore, str(e))
+            return 1
+        output = args.output or "%s.%s" % (name, args.format)
+        with open(output, "w") as f:
+            f.write(dump_template(template, args.format))
+        print "\t* Restored %s to %s" % (args.restore, output)
+
+        # attached files (shards, user_data) go next to the template
+        for filename, text in files.items():
+            path = os.path.join(os.path.dirname(output), filename)
+            if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(text.encode("utf-8") if isinstance(text, unicode) else text)
+            print "\t* Restored %s" % path
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import json
+import yaml
+
+"""
+HotLint checks a generated Heat Orchestration Template (HOT) locally,
+before (or instead of) uploading it to heat's stacks.validate.
+
+- get_param, get_resource, get_attr and depends_on references must resolve
+- resource types must be ones ReHeat generates (or a provider template);
+  templates fetched from heat (strict=False) may use any type, those are
+  left to stacks.validate
+- required properties of those types must be set
+- parameter and resource names must be unique
+- nested OS::Heat::Stack templates (inline or get_file) and the members of
+  OS::Heat::ResourceGroup are checked the same way, including whether the
+  parent passes every parameter without a default
+
+HotLinter takes the same calls as the HotWriter classes (header(),
+parameter()..., resource()..., close()) so it can be fed while a template is
+generated or streamed, keeping only the names and references it needs;
+lint_template checks a complete template.
+
+# Dependancies
+sudo pip install yaml
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["Christopher Semon", "Nick Tsamis"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson, Nick Tsamis"
+__email__ = "Mika.Ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development (JK)"
+
+
+# parameters heat provides to every stack
+PSEUDO_PARAMETERS = ["OS::stack_name", "OS::stack_id", "OS::project_id"]
+
+# resource types ReHeat generates and the properties heat requires of them
+REQUIRED_PROPERTIES = {
+    "OS::Nova::Server": ["image", "flavor"],
+    "OS::Neutron::Net": [],
+    "OS::Neutron::Subnet": ["network_id", "cidr"],
+    "OS::Neutron::Router": [],
+    "OS::Neutron::RouterGateway": ["router_id", "network_id"],
+    "OS::Neutron::RouterInterface": ["router_id"],
+    "OS::Neutron::Port": ["network_id"],
+    "OS::Neutron::FloatingIP": ["floating_network_id"],
+    "OS::Neutron::FloatingIPAssociation": ["floatingip_id", "port_id"],
+    "OS::Heat::Stack": ["template"],
+    "OS::Heat::ResourceGroup": ["resource_def"],
+}
+
+# provider templates can be used as resource types
+TEMPLATE_EXTENSIONS = (".yaml", ".yml", ".json", ".template")
+
+
+def load_template(text):
+    """ parse a yaml or json template string """
+
+    try:
+        return json.loads(text)
+    except ValueError:
+        return yaml.safe_load(text)
+
+
+def lint_template(template, files=None, name="template", strict=True):
+    """ check a complete template dict, returns a list of error messages """
+
+    linter = HotLinter(files, name, strict)
+    linter.header(template.get("heat_template_version"), template.get("description"))
+    for param, data in (template.get("parameters") or {}).items():
+        linter.parameter(param, data)
+    for resource, data in (template.get("resources") or {}).items():
+        linter.resource(resource, data)
+    return linter.close()
+
+
+class HotLinter:
+
+    def __init__(self, files=None, name="template", strict=True):
+        self.files = files or {}
+        self.name = name
+        self.strict = strict
+        self.parameters = set()
+        self.resources = set()
+        self.references = []
+        self.errors = []
+
+    def header(self, version, description):
+        if version is None:
+            self.error("heat_template_version is missing")
+
+    def parameter(self, name, data):
+        if name in self.parameters:
+            self.error("parameter %s is defined more than once" % name)
+        if not isinstance(data, dict) or "type" not in data:
+            self.error("parameter %s has no type" % name)
+        self.parameters.add(name)
+
+    def resource(self, name, data):
+        if name in self.resources:
+            self.error("resource %s is defined more than once" % name)
+        self.resources.add(name)
+        if not isinstance(data, dict) or "type" not in data:
+            self.error("resource %s has no type" % name)
+            return
+
+        properties = data.get("properties") or {}
+        self.check_type(name, data["type"], properties)
+        self.collect(name, properties)
+
+        depends_on = data.get("depends_on", [])
+        if not isinstance(depends_on, list):
+            depends_on = [depends_on]
+        for target in depends_on:
+            self.references.append((name, "depends_on", target))
+
+    def close(self):
+        """ resolve the collected references, returns the list of errors """
+
+        for name, kind, target in self.references:
+            if kind == "get_param":
+                if target not in self.parameters and target not in PSEUDO_PARAMETERS:
+                    self.error("resource %s uses undefined parameter %s" % (name, target))
+            elif target not in self.resources:
+                self.error("resource %s %s undefined resource %s" %
+                           (name, "depends on" if kind == "depends_on" else "references", target))
+            elif target == name:
+                self.error("resource %s references itself" % name)
+        return self.errors
+
+    def error(self, message):
+        self.errors.append("%s: %s" % (self.name, message))
+
+    def collect(self, name, data):
+        """ record every intrinsic function reference in a resource """
+
+        if isinstance(data, dict):
+            if len(data) == 1:
+                for kind in ("get_param", "get_resource", "get_attr"):
+                    if kind in data:
+                        target = data[kind]
+                        if isinstance(target, list) and len(target) > 0:
+                            target = target[0]
+                        self.references.append((name, kind, target))
+                        return
+            for value in data.values():
+                self.collect(name, value)
+        elif isinstance(data, list):
+            for value in data:
+                self.collect(name, value)
+
+    def check_type(self, name, resource_type, properties):
+        """ known type, required properties and nested templates """
+
+        if resource_type.endswith(TEMPLATE_EXTENSIONS):
+            self.check_nested(name, self.files.get(resource_type), properties)
+            return
+        if resource_type not in REQUIRED_PROPERTIES:
+            if self.strict:
+                self.error("resource %s has unknown type %s" % (name, resource_type))
+            return
+
+        for prop in REQUIRED_PROPERTIES[resource_type]:
+            if properties.get(prop) is None:
+                self.error("resource %s (%s) is missing required property %s" % (name, resource_type, prop))
+
+        if resource_type == "OS::Heat::Stack":
+            template = properties.get("template")
+            if isinstance(template, dict) and "get_file" in template:
+                template = self.files.get(template["get_file"])
+            self.check_nested(name, template, properties.get("parameters") or {})
+        elif resource_type == "OS::Heat::ResourceGroup":
+            resource_def = properties.get("resource_def") or {}
+            if "type" not in resource_def:
+                self.error("resource %s has a resource_def without type" % name)
+            else:
+                self.check_type("%s.resource_def" % name, resource_def["type"],
+                                resource_def.get("properties") or {})
+
+    def check_nested(self, name, template, parameters):
+        """ lint a nested template and the parameters the parent passes it """
+
+        if template is None:
+            # a file we were not given, only heat can check it
+            return
+        if not isinstance(template, dict):
+            try:
+                template = load_template(template)
+            except Exception as e:
+                self.error("resource %s has an unparsable nested template: %s" % (name, str(e)))
+                return
+
+        self.errors.extend(lint_template(template, self.files, "%s/%s" % (self.name, name), self.strict))
+        child_params = template.get("parameters") or {}
+        for param in parameters:
+            if param not in child_params:
+                self.error("resource %s passes unknown parameter %s" % (name, param))
+        for param, data in child_params.items():
+            if param not in parameters and "default" not in (data or {}):
+                self.error("resource %s does not pass required parameter %s" % (name, param))
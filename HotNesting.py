@@ -0,0 +1,302 @@
+import json
+import re
+from collections import OrderedDict
+from multiprocessing import Pool
+from HotWriter import dump_template
+
+"""
+HotNesting moves resources of a generated HOT template into child templates
+that the parent wires in as nested stacks.
+
+- extract_child builds a child template out of a set of resources, turning
+  every reference to a parent resource, parameter or file into a child parameter
+  that the parent passes through
+- shard_template splits the servers (and their ports) of a template that is
+  over Heat's max_resources_per_stack / max_template_size budget into
+  OS::Heat::Stack shards, grouped by network, image or flavor
+- collapse_servers replaces servers (and their ports) that only differ by
+  name with one OS::Heat::ResourceGroup of an inline member stack, passing
+  every member its original server name
+- dump_templates serializes the children in parallel
+
+# Dependancies
+sudo pip install yaml
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["Christopher Semon", "Nick Tsamis"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson, Nick Tsamis"
+__email__ = "Mika.Ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development (JK)"
+
+
+# heat's own defaults for max_resources_per_stack and max_template_size
+MAX_RESOURCES = 1000
+MAX_TEMPLATE_SIZE = 524288
+
+# keys servers can be grouped into shards by
+SHARD_KEYS = ["network", "image", "flavor", "none"]
+
+
+def extract_child(template, names, description):
+    """ build a child template holding the named resources of template
+
+        returns (child, values) where values are the parameters the parent
+        has to pass in for the child's references to parent parameters,
+        resources and files
+    """
+
+    params = {}
+    values = {}
+    resources = {}
+    for name in names:
+        resources[name] = _rewrite(template["resources"][name], set(names),
+                                   template.get("parameters", {}), params, values)
+
+    child = {"heat_template_version": template["heat_template_version"],
+             "description": description,
+             "parameters": params,
+             "resources": resources}
+    return child, values
+
+
+def _rewrite(data, names, parent_params, params, values):
+    """ copy data, passing parent references in through child parameters """
+
+    if isinstance(data, dict):
+        if len(data) == 1 and "get_resource" in data and data["get_resource"] not in names:
+            target = data["get_resource"]
+            param = "%s_id" % target
+            params[param] = {"type": "string",
+                             "description": "ID of %s in the parent stack" % target}
+            values[param] = {"get_resource": target}
+            return {"get_param": param}
+        if len(data) == 1 and "get_file" in data:
+            # heatclient only attaches files it finds in the template itself,
+            # not in an inline child template string
+            param = "file_%s" % re.sub(r"\W", "_", data["get_file"])
+            params[param] = {"type": "string",
+                             "description": "contents of %s" % data["get_file"]}
+            values[param] = dict(data)
+            return {"get_param": param}
+        if len(data) == 1 and "get_param" in data:
+            param = data["get_param"]
+            if isinstance(param, list):
+                param = param[0]
+            if param in parent_params:
+                params[param] = parent_params[param]
+                values[param] = {"get_param": param}
+            return dict(data)
+        return dict((key, _rewrite(value, names, parent_params, params, values))
+                    for key, value in data.items())
+    if isinstance(data, list):
+        return [_rewrite(value, names, parent_params, params, values) for value in data]
+    return data
+
+
+def server_units(template):
+    """ every server together with the ports it is attached through """
+
+    resources = template["resources"]
+    units = []
+    for name in sorted(resources):
+        if resources[name].get("type") != "OS::Nova::Server":
+            continue
+        members = [name]
+        for network in resources[name].get("properties", {}).get("networks", []):
+            port = network.get("port")
+            if isinstance(port, dict) and port.get("get_resource") in resources:
+                members.append(port["get_resource"])
+        units.append(members)
+    return units
+
+
+def unit_key(template, unit, shard_key):
+    """ value the unit is grouped by: its first network, image or flavor """
+
+    resources = template["resources"]
+    properties = resources[unit[0]].get("properties", {})
+    if shard_key == "network":
+        if len(unit) > 1:
+            value = resources[unit[1]].get("properties", {}).get("network_id")
+        else:
+            value = None
+    elif shard_key in ("image", "flavor"):
+        value = properties.get(shard_key)
+    else:
+        value = None
+    return json.dumps(value, sort_keys=True)
+
+
+def shard_template(template, child_filename, shard_key="network",
+                   max_resources=MAX_RESOURCES, max_template_size=MAX_TEMPLATE_SIZE):
+    """ split a template over budget into nested OS::Heat::Stack shards
+
+        child_filename is a pattern (e.g. compute_template.shard%d.yaml) the
+        parent pulls the shards in from with get_file. Returns (parent,
+        children) with children mapping file names to child templates; a
+        template within budget comes back unchanged with no children
+    """
+
+    children = OrderedDict()
+    resources = template["resources"]
+
+    # sizes are estimated on compact json, much cheaper than yaml
+    size = len(json.dumps(template))
+    if len(resources) <= max_resources and size <= max_template_size:
+        return template, children
+
+    units = server_units(template)
+    units.sort(key=lambda unit: unit_key(template, unit, shard_key))
+
+    # fill shards in key order, starting a new one on a new key or budget
+    shards = []
+    shard, shard_size, last_key = [], 0, None
+    for unit in units:
+        key = unit_key(template, unit, shard_key)
+        unit_size = len(json.dumps([resources[name] for name in unit]))
+        if shard and (key != last_key or
+                      len(shard) + len(unit) > max_resources or
+                      shard_size + unit_size > max_template_size):
+            shards.append(shard)
+            shard, shard_size = [], 0
+        shard.extend(unit)
+        shard_size += unit_size
+        last_key = key
+    if shard:
+        shards.append(shard)
+
+    parent = dict(template)
+    parent["resources"] = dict(resources)
+    for idx, names in enumerate(shards):
+        filename = child_filename % idx
+        child, values = extract_child(template, names, "%s (shard %d of %d)" %
+                                      (template.get("description", ""), idx + 1, len(shards)))
+        children[filename] = child
+        for name in names:
+            del parent["resources"][name]
+
+        shard_name = "shard%d" % idx
+        while shard_name in parent["resources"]:
+            shard_name += "_"
+        parent["resources"][shard_name] = {"type": "OS::Heat::Stack",
+                                           "properties": {
+                                               "template": {"get_file": filename},
+                                               "parameters": values
+                                           }}
+    return parent, children
+
+
+def _rename(data, mapping):
+    """ copy data, renaming get_resource references found in mapping """
+
+    if isinstance(data, dict):
+        if len(data) == 1 and data.get("get_resource") in mapping:
+            return {"get_resource": mapping[data["get_resource"]]}
+        return dict((key, _rename(value, mapping)) for key, value in data.items())
+    if isinstance(data, list):
+        return [_rename(value, mapping) for value in data]
+    return data
+
+
+def member_resources(template, unit):
+    """ the resources of a unit under fixed names (server, server_port0, ...)
+        with the server name left out, so identical units compare equal
+    """
+
+    mapping = {unit[0]: "server"}
+    for idx, name in enumerate(unit[1:]):
+        mapping[name] = "server_port%d" % idx
+
+    resources = {}
+    for name in unit:
+        resources[mapping[name]] = _rename(template["resources"][name], mapping)
+    resources["server"].get("properties", {}).pop("name", None)
+    return resources
+
+
+def common_prefix(names):
+    """ longest prefix shared by all names """
+
+    prefix = names[0]
+    for name in names[1:]:
+        while not name.startswith(prefix):
+            prefix = prefix[:-1]
+    return prefix
+
+
+def collapse_servers(template, min_count=2):
+    """ replace servers that only differ by name with resource groups
+
+        every server whose properties and ports match those of at least
+        min_count - 1 others is folded, with its ports, into a single
+        OS::Heat::ResourceGroup. The group members are an inline nested
+        stack, picking their server name out of the names list the group
+        passes them by %index%, so the servers keep their names
+    """
+
+    resources = template["resources"]
+    classes = OrderedDict()
+    for unit in server_units(template):
+        members = member_resources(template, unit)
+        signature = json.dumps(members, sort_keys=True)
+        classes.setdefault(signature, (members, []))[1].append(unit)
+
+    parent = dict(template)
+    parent["resources"] = dict(resources)
+    for members, units in classes.values():
+        if len(units) < min_count:
+            continue
+
+        names = [resources[unit[0]].get("properties", {}).get("name", unit[0]) for unit in units]
+        if any(not isinstance(name, basestring) or "," in name for name in names):
+            # names are passed in as a comma_delimited_list
+            continue
+        for unit in units:
+            for name in unit:
+                del parent["resources"][name]
+
+        # build the member stack, its server is named by the group
+        member = {"heat_template_version": template["heat_template_version"],
+                  "parameters": template.get("parameters", {}),
+                  "resources": members}
+        member["resources"]["server"].setdefault("properties", {})["name"] = {"get_param": ["names", {"get_param": "index"}]}
+        child, values = extract_child(member, list(members), "ReHeat resource group member")
+        child["parameters"]["names"] = {"type": "comma_delimited_list", "description": "server names of the group"}
+        child["parameters"]["index"] = {"type": "number", "description": "index of this member in names"}
+        values["names"] = names
+        values["index"] = "%index%"
+
+        # no shared prefix, the group is named after its first server
+        group_name = "%s_group" % (common_prefix(names).rstrip("-_.") or units[0][0])
+        while group_name in parent["resources"]:
+            group_name += "_"
+        parent["resources"][group_name] = {"type": "OS::Heat::ResourceGroup",
+                                           "properties": {
+                                               "count": len(units),
+                                               "resource_def": {
+                                                   "type": "OS::Heat::Stack",
+                                                   "properties": {
+                                                       "template": json.dumps(child, sort_keys=True),
+                                                       "parameters": values
+                                                   }}
+                                           }}
+    return parent
+
+
+def _dump(args):
+    return dump_template(*args)
+
+
+def dump_templates(templates, template_format="yaml", processes=None):
+    """ serialize several templates in parallel worker processes """
+
+    if len(templates) < 2:
+        return [dump_template(template, template_format) for template in templates]
+    pool = Pool(processes)
+    try:
+        return pool.map(_dump, [(template, template_format) for template in templates])
+    finally:
+        pool.close()
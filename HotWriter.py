@@ -0,0 +1,203 @@
+import gzip
+import json
+import yaml
+
+"""
+HotWriter collects the parameters and resources ReHeat generates into a
+Heat Orchestration Template (HOT).
+
+- HotWriter keeps the whole template in memory as a dict
+- StreamingHotWriter emits every parameter and resource to a file (or
+  socket) as soon as it is generated, so memory stays flat no matter how
+  many servers and ports a project has
+- StreamingJsonHotWriter does the same for JSON, which HOT also accepts
+  and which is much faster to emit and parse than yaml
+- open_output/open_input read and write templates through a streaming gzip
+  or xz compressor
+
+All of them take the same calls, in order: header(), parameter()..., resource()...,
+close().
+
+# Dependancies
+sudo pip install yaml
+sudo pip install backports.lzma (only for xz output)
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["Christopher Semon", "Nick Tsamis"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson, Nick Tsamis"
+__email__ = "Mika.Ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development (JK)"
+
+
+# emit yaml with libyaml when it is available
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
+# xz needs the lzma module (python 3 or the backports.lzma package)
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+def open_output(filename, compression=None):
+    """ open a template file for writing, compressed with gz or xz if asked """
+
+    if compression == "gz":
+        return gzip.open(filename, "wb")
+    if compression == "xz":
+        if lzma is None:
+            raise ImportError("xz output needs the lzma module (sudo pip install backports.lzma)")
+        return lzma.open(filename, "wb")
+    return open(filename, "w")
+
+
+def open_input(filename, compression=None):
+    """ open a (possibly compressed) template file for reading """
+
+    if compression == "gz":
+        return gzip.open(filename, "rb")
+    if compression == "xz":
+        if lzma is None:
+            raise ImportError("xz input needs the lzma module (sudo pip install backports.lzma)")
+        return lzma.open(filename, "rb")
+    return open(filename)
+
+
+def dump_yaml(data):
+    """ dump data to a yaml string """
+
+    return yaml.dump(data, Dumper=SafeDumper)
+
+
+def dump_template(data, template_format="yaml"):
+    """ dump a template in the requested format, yaml or json """
+
+    if template_format == "json":
+        return json.dumps(data, sort_keys=True)
+    return dump_yaml(data)
+
+
+class HotWriter:
+
+    def __init__(self):
+        self.template = {}
+
+    def header(self, version, description):
+        self.template["heat_template_version"] = version
+        self.template["description"] = description
+        self.template["parameters"] = {}
+        self.template["resources"] = {}
+
+    def parameter(self, name, data):
+        self.template["parameters"][name] = data
+
+    def resource(self, name, data):
+        self.template["resources"][name] = data
+
+    def close(self):
+        """ return the complete template """
+
+        return self.template
+
+
+class StreamingHotWriter(HotWriter):
+
+    def __init__(self, stream):
+        HotWriter.__init__(self)
+        self.stream = stream
+        self.sections = ["parameters", "resources"]
+        self.section = None
+        self.written = []
+
+    def header(self, version, description):
+        self.stream.write(dump_yaml({"heat_template_version": version,
+                                     "description": description}))
+
+    def parameter(self, name, data):
+        self.enter("parameters")
+        self.emit(name, data)
+
+    def resource(self, name, data):
+        self.enter("resources")
+        self.emit(name, data)
+
+    def close(self):
+        """ terminate the template, sections that never got an entry are empty """
+
+        for section in self.sections:
+            if section not in self.written:
+                self.stream.write("%s: {}\n" % section)
+        self.stream.flush()
+        return None
+
+    def enter(self, section):
+        """ open a top level section, each one can only be written once """
+
+        if section == self.section:
+            return
+        if section in self.written:
+            raise ValueError("HOT section %s has already been written" % section)
+        self.stream.write("%s:\n" % section)
+        self.section = section
+        self.written.append(section)
+
+    def emit(self, name, data):
+        """ write one entry indented under the current section """
+
+        for line in dump_yaml({name: data}).splitlines(True):
+            self.stream.write("  " + line)
+
+
+class StreamingJsonHotWriter(StreamingHotWriter):
+
+    def __init__(self, stream):
+        StreamingHotWriter.__init__(self, stream)
+        self.first = True
+
+    def header(self, version, description):
+        self.stream.write('{"heat_template_version": %s, "description": %s' %
+                          (json.dumps(version), json.dumps(description)))
+
+    def close(self):
+        """ terminate the open section and the template object """
+
+        if self.section is not None:
+            self.stream.write("}")
+        for section in self.sections:
+            if section not in self.written:
+                self.stream.write(', %s: {}' % json.dumps(section))
+        self.stream.write("}\n")
+        self.stream.flush()
+        return None
+
+    def enter(self, section):
+        """ open a top level section, each one can only be written once """
+
+        if section == self.section:
+            return
+        if section in self.written:
+            raise ValueError("HOT section %s has already been written" % section)
+        if self.section is not None:
+            self.stream.write("}")
+        self.stream.write(', %s: {' % json.dumps(section))
+        self.section = section
+        self.written.append(section)
+        self.first = True
+
+    def emit(self, name, data):
+        """ write one member of the current section """
+
+        if not self.first:
+            self.stream.write(", ")
+        self.stream.write("%s: %s" % (json.dumps(name), json.dumps(data, sort_keys=True)))
+        self.first = False
@@ -1,22 +1,28 @@
 import argparse
 import base64
 import ConfigParser
-import datetime
+import hashlib
 import json
-import keystoneclient.v2_0.client as ksclient
 import MySQLdb
 import os
-import requests
 import socket
 import sys
 import time
 import traceback
-import yaml
+from collections import OrderedDict
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from os import environ as env
 from heatclient.client import Client as hClient
+from HotWriter import HotWriter, StreamingHotWriter, StreamingJsonHotWriter, dump_template
+from HotWriter import open_input, open_output
+from HotNesting import MAX_RESOURCES, MAX_TEMPLATE_SIZE, SHARD_KEYS
+from HotNesting import collapse_servers, dump_templates, shard_template
+from HotArchive import HotArchive
+from HotLint import HotLinter, lint_template, load_template
 from neutronclient.v2_0 import client as neutronclient
 from novaclient import client as nClient
+from ReHeatSession import get_session, list_images, list_neutron, list_servers
 
 """
 ReHeat is a standalone program that can generate stack templates.
@@ -74,17 +80,38 @@ class ReHeat:
         # heat variables
         self.template_type     = args.template_type
         self.heat_template     = None
-        self.heat_filename     = "heat_template.yaml"
+        self.heat_yaml         = None
+        self.template_format   = args.format
+        self.compression       = args.compress
+        self.heat_filename     = self.gen_filename("heat_template")
         self.heatclient        = None
+        self.heat_stack        = None
 
         # nova and neutron variables
         self.compute_template  = None
-        self.compute_filename  = "compute_template.yaml"
+        self.compute_yaml      = None
+        self.compute_filename  = self.gen_filename("compute_template")
         self.novaclient        = None
         self.neutronclient     = None
         self.compute_data      = {}
+        self.stream            = args.stream
+        self.compute_files     = {}
+        self.compute_errors    = []
+        self.validate          = args.validate
+        self.archive           = HotArchive(args.archive) if args.archive else None
+
+        # sharding and compaction variables
+        self.collapse          = args.collapse
+        self.shard             = args.shard
+        self.shard_key         = args.shard_key
+        self.max_resources     = args.max_resources
+        self.max_template_size = args.max_template_size
+        if (self.shard or self.collapse) and self.stream:
+            print "\t! --shard and --collapse need the whole compute template in memory, ignoring --stream"
+            self.stream = False
 
         # user cred variables
+        self.session           = None
         self.tenant_id         = None
         self.userid            = None
         self.username          = None
@@ -94,6 +121,11 @@ class ReHeat:
         self.region_name       = None
         self.db_name           = "nova"
         self.db_pass           = "notnova"
+        self.userdata          = {}
+        self.userdata_chunk    = 500
+        self.userdata_mode     = args.userdata_mode
+        self.userdata_refs     = {}
+        self.userdata_dir      = "user_data"
 
         # snapshoting variables
         self.snap_threashold   = 20
@@ -104,7 +136,10 @@ class ReHeat:
         self.set_of_images     = None
         self.set_of_flavors    = None
         self.set_of_keys       = []
-        self.all_nets          = []
+        self.image_params      = {}
+        self.flavor_params     = {}
+        self.key_params        = {}
+        self.nets_by_subnet    = {}
         self.floating_ips      = []
         self.tenant_routers    = []
         self.all_ports         = []
@@ -113,6 +148,14 @@ class ReHeat:
         self.reheat_error      = False
         self.reheat_errmsg     = ""
         self.staticips         = args.staticips
+        self.bulk_interfaces   = args.bulk_interfaces
+
+        # inventory variables (filled once per run by gen_inventory)
+        self.inventory         = {}
+        self.subnet_chunk      = 100
+        self.network_fields    = ["id", "name", "tenant_id", "shared", "router:external", "subnets"]
+        self.subnet_fields     = ["id", "name", "network_id", "cidr", "gateway_ip", "allocation_pools"]
+        self.fetch_threads     = 8
 
         self.ServerCount       = 0
         self.SuppressServerStatuses = False
@@ -132,9 +175,16 @@ class ReHeat:
 
         print "\t* You have opted to generate %s file[s]" % self.template_type
         if 'all' in self.template_type:
-            self.gen_heat_data()
+            # fetch the stack template while the compute inventory is taken
+            self.gen_heat_stack()
+            pool = ThreadPool(1)
+            try:
+                heat_fetch = pool.apply_async(self.gen_heat_stack_template)
+                self.gen_compute_data()
+                heat_fetch.get()
+            finally:
+                pool.close()
             self.gen_heat_template()
-            self.gen_compute_data()
             return self.gen_compute_template()
         elif 'heat' in self.template_type:
             self.gen_heat_data()
@@ -145,6 +195,14 @@ class ReHeat:
         else:
             raise Exception("User provided an improper template type.")
 
+    def gen_filename(self, name):
+        """ template file name for the output format and compression """
+
+        filename = "%s.%s" % (name, self.template_format)
+        if self.compression:
+            filename += ".%s" % self.compression
+        return filename
+
     def set_creds(self):
         try:
             # running locally with sourced file
@@ -154,6 +212,11 @@ class ReHeat:
             self.auth_url          = env['OS_AUTH_URL']
             self.region_name       = env['OS_REGION_NAME']
             self.cmdline           = True
+
+            # one keystone session (and token cache) shared by all the clients
+            self.session           = get_session(self.auth_url, self.username, self.password,
+                                                 self.tenant_name, self.region_name)
+            self.session.verify()
         except Exception:
             self.reheat_error = True
             self.reheat_errmsg = "\t! ERROR: Could not obtain authorized reheat credentials"
@@ -178,7 +241,7 @@ class ReHeat:
 
         # use this to get the tenant_id
         try:
-            r = requests.get("http://%s:35357/v2.0/tenants" % self.ip, headers=headers)
+            r = self.session.http.get("http://%s:35357/v2.0/tenants" % self.ip, headers=headers)
             tenants = json.loads(r.text)["tenants"]
 
             # filter out other tenant information
@@ -186,7 +249,7 @@ class ReHeat:
             self.tenant_id = tenant["id"]
         except KeyError:
             # hard coded test value
-            r = requests.get("http://%s:35357/v2.0/tenants" % self.ip, headers=headers)
+            r = self.session.http.get("http://%s:35357/v2.0/tenants" % self.ip, headers=headers)
             tenants = json.loads(r.text)["tenants"]
 
             # list tenants and prompt user to select apropriate tenant_id
@@ -208,13 +271,8 @@ class ReHeat:
         """ instantiate heat orchestration client """
 
         print "\t* Generating heat client"
-        # request a new auth token from keystone
-        keystone = ksclient.Client(auth_url=self.auth_url,
-                                   username=self.username,
-                                   password=self.password,
-                                   tenant_name=self.tenant_name,
-                                   region_name=self.region_name)
-        auth_token = keystone.auth_token
+        # reuse the (possibly cached) session token
+        auth_token = self.session.auth_token
         heat_url = 'http://%s:8004/v1/%s' % (self.ip, self.tenant_id)
 
         # instantiate client
@@ -224,27 +282,40 @@ class ReHeat:
         """ instantiate nova compute client """
 
         print "\t* Generating nova client"
+        self.novaclient = self.gen_nova_worker_client()
+
+    def gen_nova_worker_client(self):
+        """ novaclient's HTTPClient keeps per request state (and a requests
+            session) that is not safe to share between threads, so each
+            concurrent fetch gets its own client sharing the same token
+        """
+
         client = nClient.get_client_class('2')
-        self.novaclient = client(self.username,
-                                 self.password,
-                                 self.tenant_name,
-                                 self.auth_url,
-                                 service_type='compute')
+        return client(self.username,
+                      self.password,
+                      self.tenant_name,
+                      self.auth_url,
+                      service_type='compute',
+                      auth_token=self.session.auth_token,
+                      bypass_url=self.session.url_for('compute'))
 
     def gen_neutron_client(self):
         """ instantiate neutron networking client """
 
         print "\t* Generating neutron client"
-        self.neutronclient = neutronclient.Client(auth_url=self.auth_url,
-                                                  username=self.username,
-                                                  password=self.password,
-                                                  tenant_name=self.tenant_name,
-                                                  region_name=self.region_name)
+        self.neutronclient = neutronclient.Client(endpoint_url=self.session.url_for('network'),
+                                                  token=self.session.auth_token)
 
     def gen_heat_data(self):
         """ generate heat template information """
 
         print "\t* Generating heat data"
+        self.gen_heat_stack()
+        self.gen_heat_stack_template()
+
+    def gen_heat_stack(self):
+        """ prompt the user for the stack to generate a template from """
+
         self.gen_heat_client()
         stacks = self.heatclient.stacks
 
@@ -258,22 +329,57 @@ class ReHeat:
         stack_num = int(raw_input("\t - "))
 
         print "\t* You have selected: %s" % stack_list[stack_num].stack_name
+        self.heat_stack = stack_list[stack_num]
+
+    def gen_heat_stack_template(self):
+        """ fetch the template of the selected stack """
 
         # stack id
-        self.heat_template = stacks.template(stack_list[stack_num].id)
+        self.heat_template = self.heatclient.stacks.template(self.heat_stack.id)
 
     def gen_compute_data(self):
         """ generate all data necessary for a complete compute template """
 
         print "\t* Generating combined nova and neutron data"
         self.init_compute_clients()
-        self.compute_data["heat_template_version"] = "2013-05-23"
-        self.compute_data["description"] = "Generated Template %s on Project %s" % \
-            (str(datetime.datetime.now().strftime("%A, %d. %B %Y %I:%M%p")), str(self.tenant_name))
-        self.compute_data["parameters"] = {}
-        self.compute_data["resources"] = {}
-        self.gen_parameters()
-        self.gen_resources()
+        self.gen_inventory()
+
+        # either stream the template straight to its file or collect it
+        if self.stream:
+            print "\t* Streaming compute template to file %s" % self.compute_filename
+            stream = open_output(self.compute_filename, self.compression)
+            if self.template_format == "json":
+                writer = StreamingJsonHotWriter(stream)
+            else:
+                writer = StreamingHotWriter(stream)
+        else:
+            stream = None
+            writer = HotWriter()
+
+        # the linter sees every entry as it is generated, which also catches
+        # duplicate names a dict would silently overwrite
+        sinks = [writer]
+        if self.validate != "remote":
+            linter = HotLinter(name=self.compute_filename)
+            sinks.append(linter)
+
+        try:
+            # no timestamp, an unchanged project gives a byte identical template
+            description = "Generated Template on Project %s" % str(self.tenant_name)
+            for sink in sinks:
+                sink.header("2013-05-23", description)
+            for name, data in self.gen_parameters():
+                for sink in sinks:
+                    sink.parameter(name, data)
+            for name, data in self.gen_resources():
+                for sink in sinks:
+                    sink.resource(name, data)
+            self.compute_data = writer.close()
+            if self.validate != "remote":
+                self.compute_errors = linter.close()
+        finally:
+            if stream is not None:
+                stream.close()
         self.compute_template = self.compute_data
 
     def init_compute_clients(self):
@@ -287,42 +393,193 @@ class ReHeat:
         self.gen_neutron_client()
 
         # instantiate heat client (used to validate templates)
-        self.gen_heat_client()
+        # unless the heat data already made one
+        if self.heatclient is None:
+            self.gen_heat_client()
+
+    def gen_neutron_worker_client(self):
+        """ neutronclient's httplib2 transport is not thread safe, so each
+            concurrent fetch gets its own client sharing the same token
+        """
+
+        httpclient = self.neutronclient.httpclient
+        return neutronclient.Client(endpoint_url=httpclient.endpoint_url,
+                                    token=httpclient.auth_token)
+
+    def run_concurrently(self, calls):
+        """ run independent api calls on a bounded thread pool and return
+            their results in order. The first failure is re-raised
+        """
+
+        pool = ThreadPool(max(1, min(self.fetch_threads, len(calls))))
+        try:
+            return pool.map(lambda call: call(), calls)
+        finally:
+            pool.close()
+
+    def gen_inventory(self):
+        """ take a single snapshot of the project so the gen_* methods never
+            have to ask the cloud the same question twice
+        """
+
+        print "\t* Taking inventory of project resources"
+        self.inventory = {}
+        nova = self.gen_nova_worker_client
+        neutron = self.gen_neutron_worker_client
+
+        # none of the listings depend on each other, fetch them all at once
+        fetches = [
+            # nova resources
+            ("servers", "id", lambda: list_servers(nova())),
+            ("flavors", "id", lambda: nova().flavors.list()),
+            ("images", "id", lambda: list_images(nova())),
+
+            # neutron resources, scoped to the project and projected down to
+            # the attributes the template needs
+            ("routers", "id", lambda: list_neutron(neutron().list_routers, "routers",
+                tenant_id=self.tenant_id,
+                fields=["id", "name", "tenant_id", "external_gateway_info"])),
+            ("ports", "id", lambda: list_neutron(neutron().list_ports, "ports",
+                tenant_id=self.tenant_id,
+                fields=["id", "device_id", "device_owner", "network_id", "fixed_ips", "created_at"])),
+            ("networks", "id", lambda: list_neutron(neutron().list_networks, "networks",
+                tenant_id=self.tenant_id,
+                fields=self.network_fields)),
+            ("shared_networks", "id", lambda: list_neutron(neutron().list_networks, "networks",
+                shared=True,
+                fields=self.network_fields)),
+            ("floatingips", "id", lambda: list_neutron(neutron().list_floatingips, "floatingips",
+                tenant_id=self.tenant_id,
+                fields=["id", "port_id", "fixed_ip_address", "floating_ip_address",
+                        "floating_network_id"]))
+        ]
+        # each worker streams its listing page by page into an index, ports
+        # stay in neutron's order until the server interfaces are taken
+        indexes = self.run_concurrently([lambda fetch=fetch: self.index_by(fetch[2](), fetch[1], fetch[0] != "ports")
+                                         for fetch in fetches])
+        for fetch, index in zip(fetches, indexes):
+            self.inventory[fetch[0]] = index
+
+        # shared networks of other tenants are part of the project too
+        for net_id, network in self.inventory.pop("shared_networks").items():
+            self.inventory["networks"].setdefault(net_id, network)
+        self.inventory["networks"] = OrderedDict(sorted(self.inventory["networks"].items()))
+
+        # server interfaces are the compute:<zone> owned ports, grouped by server
+        # in attach order: by creation time where neutron reports it, else in
+        # neutron's own order, which is what interface_list returns
+        compute_ports = [port for port in self.inventory["ports"].values()
+                         if port["device_owner"].startswith("compute:")]
+        compute_ports.sort(key=lambda port: port.get("created_at") or "")
+        self.inventory["server_ports"] = self.group_by(compute_ports, "device_id")
+
+        # routers find their ports by device
+        self.inventory["ports"] = OrderedDict(sorted(self.inventory["ports"].items()))
+        self.inventory["ports_by_device"] = self.group_by(self.inventory["ports"].values(), "device_id")
+
+        # ports and router interfaces refer to networks by name
+        self.inventory["networks_by_name"] = {}
+        for network in self.inventory["networks"].values():
+            self.inventory["networks_by_name"].setdefault(network["name"], network)
+
+        # only the subnets of networks that end up in the template are needed
+        networks_in_use = [net for net in self.inventory["networks"].values() if (net["tenant_id"] == self.tenant_id or
+            (net["shared"] == True) and net['router:external'] == False)]
+        self.inventory["subnets"] = self.gen_subnet_index(networks_in_use)
+
+    def group_by(self, items, key):
+        """ group a list of neutron dicts into lists sharing the same value of key """
+
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(item[key], []).append(item)
+        return groups
+
+    def gen_subnet_index(self, networks):
+        """ fetch the subnets of the given networks with bulk list_subnets calls
+            instead of one show_subnet round trip per subnet
+        """
+
+        subnets = OrderedDict()
+        network_ids = [net["id"] for net in networks]
+
+        # neutron accepts repeated network_id filters, chunk them to keep the url short
+        for idx in range(0, len(network_ids), self.subnet_chunk):
+            chunk = network_ids[idx:idx + self.subnet_chunk]
+            for subnet in list_neutron(self.neutronclient.list_subnets, "subnets",
+                                       network_id=chunk, fields=self.subnet_fields):
+                subnets[subnet["id"]] = subnet
+        return OrderedDict(sorted(subnets.items()))
+
+    def get_subnet(self, subnet_id):
+        """ look up a subnet in the inventory, falling back to neutron for
+            subnets outside of the networks in use (e.g. on external networks)
+        """
+
+        if subnet_id not in self.inventory["subnets"]:
+            self.inventory["subnets"][subnet_id] = self.neutronclient.show_subnet(subnet_id)["subnet"]
+        return self.inventory["subnets"][subnet_id]
+
+    def index_by(self, items, key, sort=True):
+        """ key api objects (or neutron dicts) by one of their attributes as
+            they are streamed in page by page. The index is sorted by key so
+            the generated template does not depend on api ordering
+        """
+
+        index = OrderedDict()
+        for item in items:
+            if isinstance(item, dict):
+                index[item[key]] = item
+            else:
+                index[getattr(item, key)] = item
+        if sort:
+            return OrderedDict(sorted(index.items()))
+        return index
 
     def gen_parameters(self):
         """ generate parameters for compute template """
 
         print "\t* Adding parameters to compute template"
         # get all the server client
-        servers = self.novaclient.servers.list()
+        servers = self.inventory["servers"].values()
 
         # add all key_pair_names
-        self.gen_key_name_parameters(servers)
+        for item in self.gen_key_name_parameters(servers):
+            yield item
 
         # add all images
-        self.gen_image_parameters(servers)
+        for item in self.gen_image_parameters(servers):
+            yield item
 
         # add all flavors
-        self.gen_flavor_parameters(servers)
+        for item in self.gen_flavor_parameters(servers):
+            yield item
 
         # add all networks
-        self.gen_network_parameters()
+        for item in self.gen_network_parameters():
+            yield item
+
+        # add all shared user_data
+        for item in self.gen_userdata_parameters(servers):
+            yield item
 
     def gen_key_name_parameters(self, servers):
-        """ generate all the key_pair names and add them to compute_data """
+        """ generate all the key_pair name parameters """
 
-        self.set_of_keys = set(map(lambda server: server.key_name, servers))
+        self.set_of_keys = sorted(set(map(lambda server: server.key_name, servers)))
+        self.key_params = {}
         key_idx = ""
         for idx, key_pair in enumerate(self.set_of_keys):
             data = {"type": "string",
                     "description": "Name of keypair to assign to servers",
                     "default": key_pair}
-            self.compute_data["parameters"]["key_name%s" % key_idx] = data
+            yield "key_name%s" % key_idx, data
+            self.key_params[key_pair] = "key_name%s" % key_idx
             if len(self.set_of_keys) >= 1:
                 key_idx = str(1+idx)
 
     def gen_image_parameters(self, servers):
-        """ generate all the images and add them to compute_data """
+        """ generate all the image parameters """
 
         self.snapshot_ids = []
         # get all the images
@@ -331,6 +588,9 @@ class ReHeat:
         # ask user if they want snapshots of information
         self.set_of_images = []
 
+        # server id -> image parameter name
+        self.image_params = {}
+
         snapping = self.using_snapshots and (len(server_images) < self.snap_threashold)
 
         # if using snapshots:
@@ -339,7 +599,7 @@ class ReHeat:
             print "\t* You have opted to generate snapshots"
             self.using_snapshots = True
             # create snapshot
-            for server in server_images:
+            for server in sorted(server_images):
                 try:
                     snapshot_id = self.novaclient.servers.create_image(server[0], "%s_snapshot" % server[1])
                     data = (server[0], snapshot_id)
@@ -351,11 +611,12 @@ class ReHeat:
 
             # add image information to template
             image_idx = ""
-            for idx, image in enumerate(set(self.snapshot_ids)):
+            for idx, image in enumerate(sorted(set(self.snapshot_ids))):
                 data = {"type": "string",
                         "description": "Name of image to use for servers",
                         "default": image[1]}
-                self.compute_data["parameters"]["image%s" % image_idx] = data
+                yield "image%s" % image_idx, data
+                self.image_params[image[0]] = "image%s" % image_idx
                 if len(self.snapshot_ids) >= 1:
                     image_idx = str(1+idx)
         else:
@@ -366,36 +627,43 @@ class ReHeat:
                     (self.snap_threashold, (len(server_images) - self.snap_threashold))
                 print "\t! Snapshots will not be generated."
 
-            images = self.novaclient.images.list()
             ##MODIFY FOR IMAGE NAME INSTEAD OF ID
-            for image in images:
-                for server in server_images:
-                    if image.id == server[2]:
-                        self.set_of_images.append(image.id)
+            for server in server_images:
+                if server[2] in self.inventory["images"]:
+                    self.set_of_images.append(server[2])
 
             # add image information to template
+            image_names = {}
             image_idx = ""
-            for idx, image in enumerate(set(self.set_of_images)):
+            for idx, image in enumerate(sorted(set(self.set_of_images))):
                 data = {"type": "string",
                         "description": "Name of image to use for servers",
                         "default": image}
-                self.compute_data["parameters"]["image%s" % image_idx] = data
+                yield "image%s" % image_idx, data
+                image_names[image] = "image%s" % image_idx
                 if len(self.set_of_images) >= 1:
                     image_idx = str(1+idx)
 
+            for server in server_images:
+                if server[2] in image_names:
+                    self.image_params[server[0]] = image_names[server[2]]
+
     def gen_flavor_parameters(self, servers):
-        """ generate all the images and add them to compute_data """
+        """ generate all the flavor parameters """
 
         # get all the flavors
-        flavors = self.novaclient.flavors.list()
+        flavors = self.inventory["flavors"].values()
         server_flavors = set([x.flavor["id"] for x in servers])
-        self.set_of_flavors = set(filter(lambda flavor: flavor.id in server_flavors, flavors))
+        self.set_of_flavors = sorted(set(filter(lambda flavor: flavor.id in server_flavors, flavors)),
+                                     key=lambda flavor: flavor.id)
+        self.flavor_params = {}
         flavor_idx = ""
         for idx, flavor in enumerate(self.set_of_flavors):
             data = {"type": "string",
                     "description": "Flavor to use for servers",
                     "default": flavor.name}
-            self.compute_data["parameters"]["flavor%s" % flavor_idx] = data
+            yield "flavor%s" % flavor_idx, data
+            self.flavor_params[flavor.id] = "flavor%s" % flavor_idx
             if len(self.set_of_flavors) >= 1:
                 flavor_idx = str(1+idx)
 
@@ -405,8 +673,8 @@ class ReHeat:
         print "\t* Adding net and subnet parameters to compute template"
 
         # add all the routers
-        all_routers = self.neutronclient.list_routers()["routers"]
-        self.all_ports = self.neutronclient.list_ports()["ports"]
+        all_routers = self.inventory["routers"].values()
+        self.all_ports = self.inventory["ports"].values()
 
         self.tenant_routers = filter(lambda router: router['tenant_id'] == self.tenant_id , all_routers)
 
@@ -418,11 +686,11 @@ class ReHeat:
                         "description": "ID of public network",
                         "default": router_gateway["network_id"]
                         }
-                self.compute_data["parameters"]["public_net_%s" % str(idx)] = data
+                yield "public_net_%s" % str(idx), data
             except:
                 print "\t! Could not add external_gateway_info for %s" % router["name"]
 
-        networks = self.neutronclient.list_networks()["networks"]
+        networks = self.inventory["networks"].values()
         # filter all networks that match
         filtered_networks = [net for net in networks if (net["tenant_id"] == self.tenant_id or
             (net["shared"] is True) and net['router:external'] is False) and (net["name"] != "public")]
@@ -430,47 +698,49 @@ class ReHeat:
         # obtain subnet information
         shared_net_id = 0
         for network in filtered_networks:
-            for subnet in network["subnets"]:
-                if network["shared"] != True:
-                    subnet_info = self.neutronclient.show_subnet(subnet)["subnet"]
+            subnets = sorted(network["subnets"])
+            if network["shared"] != True and subnets:
+                # generate private net, once for all of its subnets
+                # private name
+                data = {"type": "string",
+                        "description": "Name of network",
+                        "default": network["name"]}
+                yield "%s_net_name" % (network["name"]), data
 
-                    # generate private net
-                    # private name
-                    data = {"type": "string",
-                            "description": "Name of network",
-                            "default": network["name"]}
-                    self.compute_data["parameters"]["%s_net_name" % (network["name"])] = data
+            for subnet in subnets:
+                if network["shared"] != True:
+                    subnet_info = self.inventory["subnets"][subnet]
 
                     # private cidr
                     data = {"type": "string",
                             "description": "Network address (CIDR notation)",
                             "default": subnet_info["cidr"]}
-                    self.compute_data["parameters"]["%s_%s_cidr" % (network["name"], subnet_info["name"])] = data
+                    yield "%s_%s_cidr" % (network["name"], subnet_info["name"]), data
 
                     # private gateway
                     data = {"type": "string",
                             "description": "Network gateway address",
                             "default": subnet_info["gateway_ip"]}
-                    self.compute_data["parameters"]["%s_%s_gateway" % (network["name"], subnet_info["name"])] = data
+                    yield "%s_%s_gateway" % (network["name"], subnet_info["name"]), data
 
                     # private pool start
                     data = {"type": "string",
                             "description": "Start of network IP address allocation pool",
                             "default": subnet_info["allocation_pools"][0]["start"]}
-                    self.compute_data["parameters"]["%s_%s_pool_start" % (network["name"], subnet_info["name"])] = data
+                    yield "%s_%s_pool_start" % (network["name"], subnet_info["name"]), data
 
                     # private pool end
                     data = {"type": "string",
                             "description": "End of network IP address allocation pool",
                             "default": subnet_info["allocation_pools"][0]["end"]}
-                    self.compute_data["parameters"]["%s_%s_pool_end" % (network["name"], subnet_info["name"])] = data
+                    yield "%s_%s_pool_end" % (network["name"], subnet_info["name"]), data
                 else:
                     print "\t* Adding shared network: %s" % network["name"]
                     data = {"type": "string",
                         "description": "ID of detected shared network",
                         "default": network["id"]
                         }
-                    self.compute_data["parameters"]["shared_net_%s" % str(shared_net_id)] = data
+                    yield "shared_net_%s" % str(shared_net_id), data
                     shared_net_id += 1
 
     def gen_resources(self):
@@ -479,20 +749,23 @@ class ReHeat:
         print "\t* Adding resources to compute template"
 
         # add all the nets and subnets
-        self.gen_net_resources()
+        for item in self.gen_net_resources():
+            yield item
 
         # add all routers
-        self.gen_router_resources()
+        for item in self.gen_router_resources():
+            yield item
 
         # add all servers/intances
-        self.gen_server_resources()
+        for item in self.gen_server_resources():
+            yield item
 
     def gen_net_resources(self):
         """ Genererate all net and subnet resources """
 
         print "\t* Adding net and subnet resources to compute template"
 
-        networks = self.neutronclient.list_networks()["networks"]
+        networks = self.inventory["networks"].values()
 
         # filter all networks that match
         filtered_networks = [net for net in networks if (net["tenant_id"] == self.tenant_id or
@@ -501,20 +774,22 @@ class ReHeat:
         # obtain subnet information
         for network in filtered_networks:
             if network["shared"] is not True:
-
-                for subnet in network["subnets"]:
-                    subnet_info = self.neutronclient.show_subnet(subnet)["subnet"]
-
-                    # save this information for router interfaces
-                    self.all_nets.append((subnet_info, "%s" % network["name"], "%s" % subnet_info["name"]))
-
-                    # generate private net
+                subnets = sorted(network["subnets"])
+                if subnets:
+                    # generate private net, once for all of its subnets
                     data = {"type": "OS::Neutron::Net",
                             "properties":
                                 {"name":
                                     {"get_param": "%s_%s_name" % (network["name"], "net")}
                             }
                         }
+                    yield "%s" % network["name"], data
+
+                for subnet in subnets:
+                    subnet_info = self.inventory["subnets"][subnet]
+
+                    # save this information for router interfaces
+                    self.nets_by_subnet[subnet_info["id"]] = ("%s" % network["name"], "%s" % subnet_info["name"])
 
                     start_ = {"get_param": "%s_%s_pool_start" % (network["name"], subnet_info["name"])}
 
@@ -529,13 +804,12 @@ class ReHeat:
                                 ]
                             }
                         }
-                    self.compute_data["resources"]["%s" % network["name"]] = data
-                    self.compute_data["resources"]["%s" % subnet_info["name"]] = data2
+                    yield "%s" % subnet_info["name"], data2
             else:
                 # add shared network to the full list of networks
-                for subnet in network["subnets"]:
-                    subnet_info = self.neutronclient.show_subnet(subnet)["subnet"]
-                    self.all_nets.append((subnet_info, "%s" % network["name"], "%s" % subnet_info["name"]))
+                for subnet in sorted(network["subnets"]):
+                    subnet_info = self.inventory["subnets"][subnet]
+                    self.nets_by_subnet[subnet_info["id"]] = ("%s" % network["name"], "%s" % subnet_info["name"])
 
     def gen_router_resources(self):
         """ Generate all the router resources """
@@ -546,16 +820,13 @@ class ReHeat:
         year = version.version_string()
 
         for idx, router in enumerate(self.tenant_routers):
-            router_ports = []
-            for port in self.all_ports:
-                if router["id"] == port["device_id"]:
-                    router_ports.append(port)
+            router_ports = self.inventory["ports_by_device"].get(router["id"], [])
 
             # add the router definition
             if "2013" in year:
                 # Havana Format
                 data = {"type": "OS::Neutron::Router"}
-                self.compute_data["resources"]["router%s" % str(idx)] = data
+                yield "router%s" % str(idx), data
 
                 #  routers without external gateway
                 if router["external_gateway_info"] is not None:
@@ -570,7 +841,7 @@ class ReHeat:
                                 "network_id": netid
                             }}
 
-                    self.compute_data["resources"]["router_gateway%s" % str(idx)] = data
+                    yield "router_gateway%s" % str(idx), data
 
             else:
                 # Icehouse Format
@@ -592,7 +863,7 @@ class ReHeat:
                                 "name": rtrName
                                 }
                             }
-                self.compute_data["resources"]["router%s" % str(idx)] = data
+                yield "router%s" % str(idx), data
 
             # internal port information needed
             internal_interfaces = filter(lambda port: port["device_owner"] == "network:router_interface", router_ports)
@@ -608,15 +879,15 @@ class ReHeat:
                                 "router_id": {"get_resource": "router%s" % str(idx)},
                                 "port_id": {"get_resource": "port_%s_%s" % (str(idx), str(idxs))}
                             }}
-                    self.compute_data["resources"]["router_interface%s_%s" % (str(idx), str(idxs))] = data
+                    yield "router_interface%s_%s" % (str(idx), str(idxs)), data
 
                     #  create router port
-                    network = self.neutronclient.show_subnet(fixedip["subnet_id"])["subnet"]["network_id"]
-                    net_name = "%s" % str(self.neutronclient.show_network(network)["network"]["name"])
-                    net_id = self.neutronclient.show_network(network)["network"]["id"]
+                    network = self.get_subnet(fixedip["subnet_id"])["network_id"]
+                    net = self.inventory["networks"][network]
+                    net_name = "%s" % str(net["name"])
+                    net_id = net["id"]
 
                     fixed_ips = [{"ip_address": fixedip["ip_address"]}]
-                    net = self.neutronclient.show_network(network)["network"]
                     if net["shared"] is True:
                         data = {"type": "OS::Neutron::Port",
                                 "properties": {
@@ -629,13 +900,13 @@ class ReHeat:
                                     "fixed_ips": fixed_ips,
                                     "network_id": {"get_resource": net_name}
                                 }}
-                    self.compute_data["resources"]["port_%s_%s" % (str(idx), str(idxs))] = data
+                    yield "port_%s_%s" % (str(idx), str(idxs)), data
 
     def gen_server_resources(self):
         """ Generate all the instance resources """
         print "\t* Adding server resources to compute template"
         # add all instances
-        servers = self.novaclient.servers.list()
+        servers = self.inventory["servers"].values()
 
         # add all ports
         ports = []
@@ -643,36 +914,30 @@ class ReHeat:
         self.set_of_images = set(self.set_of_images)
 
         for server in servers:
-            if self.using_snapshots:
-                # get template image id
-                images = [(idx, x[1]) for idx, x in enumerate(set(self.snapshot_ids)) if x[0] == server.id]
-            else:
-                # get template image id
-                images = [(idx, x) for idx, x in enumerate(self.set_of_images) if x == server.image["id"]]
+            # get template image id (snapshot or base image)
+            image_ = self.image_params.get(server.id)
 
             # continue to next iteration.
-            if len(images) == 0:
+            if image_ is None:
                 continue
-            image_num = images[0][0] if images[0][0] > 0 else ""
-            image_ = "image%s" % image_num
 
             # get template flavor id
-            flavors = [(idx, x) for idx, x in enumerate(self.set_of_flavors) if x.id == server.flavor["id"]]
-            flavor_num = flavors[0][0] if flavors[0][0] > 0 else ""
-            flavor_ = "flavor%s" % flavor_num
+            flavor_ = self.flavor_params[server.flavor["id"]]
 
             # get template keys
-            keys = [(idx, x) for idx, x in enumerate(self.set_of_keys) if x == server.key_name]
-            key_num = keys[0][0] if keys[0][0] > 0 else ""
-            key_ = "key_name%s" % key_num
+            key_ = self.key_params[server.key_name]
 
             # get template network info
             # novaclient.servers.interface_list(servers[3])[1]._info
             # instead of server.interface_list(server.id)
             # bug : github #1280453
             networks_ = []
-            with self.suppress():
-                ports = self.novaclient.servers.interface_list(server)
+            if self.bulk_interfaces:
+                # interfaces come from the compute ports already in the inventory
+                ports = self.inventory["server_ports"].get(server.id, [])
+            else:
+                with self.suppress():
+                    ports = [port._info for port in self.novaclient.servers.interface_list(server)]
 
             for idx, port in enumerate(ports):
                 networks_.append({
@@ -706,16 +971,61 @@ class ReHeat:
             if user_data is not None:
                 if "case3" in case:
                     data["properties"]["user_data_format"] = "RAW"
-                data["properties"]["user_data"] = user_data
+                data["properties"]["user_data"] = self.userdata_refs.get(server.id, user_data)
 
-            self.compute_data["resources"][server.name] = data
+            yield server.name, data
 
             # add server port information
-            self.gen_port_resources(server, ports)
+            for item in self.gen_port_resources(server, ports):
+                yield item
 
             # add floating ip information
             self.gen_floating_ip_resources(server)
 
+    def gen_userdata_parameters(self, servers):
+        """ Pull the user_data of every server up front and, unless it is
+            inlined, emit each distinct payload once for the servers to share
+        """
+
+        try:
+            self.userdata = self.gen_userdata_map([server.id for server in servers])
+        except Exception as e:
+            print "\t! Could not obtain userdata information: %s" % str(e)
+            self.userdata = {}
+
+        if self.userdata_mode == "inline":
+            return
+
+        # servers by the hash of their payload
+        payloads = OrderedDict()
+        for uuid, (case, user_data) in sorted(self.userdata.items()):
+            if user_data is not None:
+                payloads.setdefault(hashlib.sha1(user_data).hexdigest(), []).append(uuid)
+
+        print "\t* Adding %d distinct user_data payloads as %ss" % (len(payloads), self.userdata_mode)
+        for digest, uuids in payloads.items():
+            user_data = self.userdata[uuids[0]][1]
+            if self.userdata_mode == "file":
+                # side file of the export bundle, every payload gets one
+                path = "%s/%s" % (self.userdata_dir, digest)
+                if not os.path.isdir(self.userdata_dir):
+                    os.makedirs(self.userdata_dir)
+                with open(path, "w") as f:
+                    f.write(user_data)
+                self.compute_files[path] = user_data
+                ref = {"get_file": path}
+            elif len(uuids) > 1:
+                # only payloads that are actually shared become parameters
+                name = "user_data_%s" % digest[:12]
+                yield name, {"type": "string",
+                             "default": user_data,
+                             "description": "user_data shared by %d servers" % len(uuids)}
+                ref = {"get_param": name}
+            else:
+                continue
+            for uuid in uuids:
+                self.userdata_refs[uuid] = ref
+
     def gen_userdata(self, uuid):
         """ Generate all the user data information
             Ideally, this would tap into the DBAPI and provide a db context
@@ -728,11 +1038,39 @@ class ReHeat:
         if (self.SuppressServerStatuses is False):
             print "\t* Generating userdata information if available"
 
+        return self.userdata.get(uuid, ("case1", None))
+
+    def gen_userdata_map(self, uuids):
+        """ Pull the user_data of all the given servers over one connection
+            with batched, parameterized queries. Returns uuid -> (case, payload)
+        """
+
+        # json (--format json, and the --archive and --collapse digests) only
+        # carries text, yaml writes any other payload as !!binary
+        needs_text = self.template_format == "json" or self.archive is not None or self.collapse
+        userdata = {}
         db = MySQLdb.connect(host="localhost", user=self.db_name, passwd=self.db_pass, db=self.db_name)
-        cursor = db.cursor()
-        cursor.execute("SELECT user_data from instances where uuid='%s'" % (uuid,))
         try:
-            user_data = cursor.fetchone()[0]
+            cursor = db.cursor()
+            for idx in range(0, len(uuids), self.userdata_chunk):
+                chunk = uuids[idx:idx + self.userdata_chunk]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute("SELECT uuid, user_data from instances where uuid IN (%s)" % placeholders, chunk)
+                for uuid, user_data in cursor.fetchall():
+                    userdata[uuid] = self.decode_userdata(user_data)
+                    if needs_text and not self.is_text(userdata[uuid][1]):
+                        print "\t! user_data of server %s is not UTF-8 text (e.g. gzip compressed " \
+                              "cloud-init), --format json, --archive and --collapse cannot carry it" % uuid
+                        print "Exiting ..."
+                        sys.exit(1)
+        finally:
+            db.close()
+        return userdata
+
+    def decode_userdata(self, user_data):
+        """ Decode a raw user_data column and split the cloud-init MIME payload """
+
+        try:
             searching_for = 'filename="cfn-userdata"'
             if user_data is not None:
                 decoded = base64.decodestring(user_data)
@@ -748,14 +1086,23 @@ class ReHeat:
                     # with user_data in cloud init
                     return ("case2", cloud_userdata)
                 # with user_data only
-                return ("case3", base64.decodestring(user_data))
+                return ("case3", decoded)
             else:
                 return("case1", None)
         except Exception as e:
             print "Exception in userdata capture: \n", str(e)
-            return None
-        db.commit()
-        db.close()
+            return ("case1", None)
+
+    def is_text(self, payload):
+        """ whether a decoded user_data payload is UTF-8 text """
+
+        if payload is None:
+            return True
+        try:
+            payload.decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return True
 
     def gen_port_resources(self, server, ports):
         """ Generate all the port interface resources """
@@ -766,23 +1113,18 @@ class ReHeat:
         for idx, port in enumerate(ports):
 
             # get fixedips
-            fixed_ip = port._info["fixed_ips"]
+            fixed_ip = port["fixed_ips"]
             fixed_ip_address = fixed_ip[0]["ip_address"]
 
-            # filter all_nets by subnet_id
-            net_data = []
-            fip = None
-            for x in self.all_nets:
-                for fip in fixed_ip:
-                    if x[0]["id"] in fip["subnet_id"]:
-                        net_data.append(x)
+            # look up the (network, subnet) of the first known subnet_id
+            fips = [fip for fip in fixed_ip if fip["subnet_id"] in self.nets_by_subnet]
 
-            if len(net_data) > 0:
-                net = net_data[0][1]
-                subnet = net_data[0][2]
+            if len(fips) > 0:
+                fip = fips[0]
+                net, subnet = self.nets_by_subnet[fip["subnet_id"]]
 
-                networkID = [netw['id'] for netw in self.neutronclient.list_networks()['networks'] if netw['name'] == net][0]
-                networkIsShared = self.neutronclient.show_network(networkID)['network']['shared']
+                networkID = self.inventory["networks_by_name"][net]["id"]
+                networkIsShared = self.inventory["networks_by_name"][net]["shared"]
 
                 if networkIsShared is True:
                     port_properties_ = {
@@ -814,14 +1156,14 @@ class ReHeat:
                 print "!!Probable error grabbing port information for server %s!!" % (server.name)
                 data = {"type": "OS::Neutron::Port"}
 
-            self.compute_data["resources"]["%s_port%s" % (server.name, port_idx)] = data
+            yield "%s_port%s" % (server.name, port_idx), data
             if len(ports) >= 1:
                 port_idx = str(1 + idx)
 
     def gen_floating_ip_resources(self, server):
         """ Generate all of the FloatingIP instance information """
 
-        floating_resources = self.neutronclient.list_floatingips()["floatingips"]
+        floating_resources = self.inventory["floatingips"].values()
         # self.floating_ips = filter(lambda router: router['tenant_id']== self.tenant_id
         #     and router["port_id"] is not None, floating_resources)
 
@@ -832,16 +1174,19 @@ class ReHeat:
         """ Generate a yaml file of the heat data """
 
         print "\t* Generating heat template in file: %s" % self.heat_filename
+        self.heat_yaml = self.serialize(self.heat_template)
         if self.cmdline:
-            with open(self.heat_filename, 'w') as f:
-                f.write(yaml.safe_dump(self.heat_template))
-
-            try:
-                self.heatclient.stacks.validate(template=yaml.safe_dump(self.heat_template))
-            except Exception as e:
-                print "Unfortunately your file is malformed. Received error: (%s)" % str(e)
-                print "Exiting ..."
-                sys.exit(1)
+            with open_output(self.heat_filename, self.compression) as f:
+                f.write(self.heat_yaml)
+
+            # only HOT templates can be checked locally, heat may hand back cfn.
+            # The stack can use any resource type, heat checks those itself
+            errors = []
+            if "heat_template_version" in self.heat_template:
+                errors = lint_template(self.heat_template, name=self.heat_filename, strict=False)
+            self.validate_template(self.heat_filename, self.heat_yaml, errors)
+            if self.archive is not None:
+                self.archive.store("heat_template", self.heat_template, tenant=self.tenant_name)
 
         return self.heat_template
 
@@ -849,18 +1194,84 @@ class ReHeat:
         """ Generate a yaml file of the nova and neutron data """
 
         print "\t* Generating compute template in file %s" % self.compute_filename
-        if self.cmdline:
-            with open(self.compute_filename, 'w') as f:
-                f.write(yaml.safe_dump(self.compute_template))
+        if self.stream:
+            # the template was written while it was generated, only read it
+            # back for the remote validation
+            with open_input(self.compute_filename, self.compression) as f:
+                self.compute_yaml = f.read()
+        else:
+            if self.collapse:
+                self.compute_template = collapse_servers(self.compute_template)
+            if self.shard:
+                self.gen_shards()
+            if (self.collapse or self.shard) and self.validate != "remote":
+                # check the nested stacks as well
+                for error in lint_template(self.compute_template, self.compute_files, self.compute_filename):
+                    if error not in self.compute_errors:
+                        self.compute_errors.append(error)
+            self.compute_yaml = self.serialize(self.compute_template)
+            if self.cmdline:
+                with open_output(self.compute_filename, self.compression) as f:
+                    f.write(self.compute_yaml)
+
+        self.validate_template(self.compute_filename, self.compute_yaml, self.compute_errors, self.compute_files)
+        if self.archive is not None:
+            # a streamed template only exists in its file
+            template = load_template(self.compute_yaml) if self.stream else self.compute_template
+            self.archive.store("compute_template", template, self.compute_files, tenant=self.tenant_name)
+        return self.compute_template
+
+    def validate_template(self, filename, text, errors, files=None):
+        """ report the local lint errors and/or run heat's stacks.validate,
+            keeping the written file around when either fails
+        """
 
+        if self.validate != "remote" and errors:
+            print "Unfortunately your file is malformed. Found %d error[s]:" % len(errors)
+            for error in errors:
+                print "\t! %s" % error
+            self.validation_failed(filename)
+
+        if self.validate != "local":
             try:
-                self.heatclient.stacks.validate(template=yaml.safe_dump(self.compute_template))
+                self.heatclient.stacks.validate(template=text, files=files or {})
             except Exception as e:
                 print "Unfortunately your file is malformed. Received error: (%s)" % str(e)
-                print "Exiting ..."
-                sys.exit(1)
+                self.validation_failed(filename)
 
-        return self.compute_template
+    def validation_failed(self, filename):
+        if self.cmdline or self.stream:
+            print "The generated template was kept in %s for inspection" % filename
+        print "Exiting ..."
+        sys.exit(1)
+
+    def gen_shards(self):
+        """ split a compute template over heat's resource or size budget into
+            nested stacks, one child template file per shard
+        """
+
+        name = "compute_template.shard%%d.%s" % self.template_format
+        self.compute_template, shards = shard_template(self.compute_template, name, self.shard_key,
+                                                       self.max_resources, self.max_template_size)
+        if not shards:
+            return
+
+        print "\t* Splitting compute template into %d nested stacks by %s" % (len(shards), self.shard_key)
+        texts = dump_templates(shards.values(), self.template_format)
+        self.compute_files.update(zip(shards.keys(), texts))
+        if self.cmdline:
+            # the parent pulls the shards in with get_file under these names,
+            # so they are left uncompressed like the user_data files
+            for filename, text in zip(shards.keys(), texts):
+                with open(filename, "w") as f:
+                    f.write(text)
+
+    def serialize(self, template):
+        """ dump a template (yaml or json) a single time so the same bytes
+            can be written, validated and returned
+        """
+
+        return dump_template(template, self.template_format)
 
     @contextmanager
     def suppress(self):
@@ -881,8 +1292,43 @@ def main():
                          all], (default: all)', required=True)
     parser.add_argument('--snapshots', default=False, action='store_true',
                          help='If set, create snapshots')
+    parser.add_argument('--format', default='yaml', choices=['yaml', 'json'],
+                         help='template output format [yaml, json], (default: yaml)')
+    parser.add_argument('--compress', default=None, choices=['gz', 'xz'],
+                         help='If set, compress the template files [gz, xz]; \
+                         shard and user_data files stay uncompressed so \
+                         get_file resolves once the template is decompressed')
     parser.add_argument('--staticips', default=False, action='store_true',
                          help='If set, set static ips')
+    parser.add_argument('--stream', default=False, action='store_true',
+                         help='If set, write the compute template while it is \
+                         generated instead of holding it in memory')
+    parser.add_argument('--bulk-interfaces', default=False, action='store_true',
+                         help='If set, derive server interfaces from the neutron port list \
+                         instead of asking nova for each server')
+    parser.add_argument('--archive', default=None,
+                         help='If set, also store the templates in this content addressed \
+                         archive directory (see HotArchive.py to restore them)')
+    parser.add_argument('--validate', default='both', choices=['local', 'remote', 'both'],
+                         help='check templates locally, with heat or both, remote only \
+                         runs when the local check passes [local, remote, both], (default: both)')
+    parser.add_argument('--userdata-mode', default='inline', choices=['inline', 'param', 'file'],
+                         help='how user_data is written [inline, param, file]: param shares \
+                         repeated payloads as parameters, file writes each payload once to \
+                         user_data/ for get_file, (default: inline)')
+    parser.add_argument('--collapse', default=False, action='store_true',
+                         help='If set, fold servers that only differ by name into \
+                         resource groups')
+    parser.add_argument('--shard', default=False, action='store_true',
+                         help='If set, split a compute template over the heat budget \
+                         into nested stacks')
+    parser.add_argument('--shard-key', default='network', choices=SHARD_KEYS,
+                         help='group servers into shards by [network, image, flavor, none], \
+                         (default: network)')
+    parser.add_argument('--max-resources', default=MAX_RESOURCES, type=int,
+                         help='resources per template before sharding, (default: %d)' % MAX_RESOURCES)
+    parser.add_argument('--max-template-size', default=MAX_TEMPLATE_SIZE, type=int,
+                         help='template bytes before sharding, (default: %d)' % MAX_TEMPLATE_SIZE)
     args = parser.parse_args()
     try:
         gt = ReHeat(args)
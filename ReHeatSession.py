@@ -0,0 +1,259 @@
+import datetime
+import hashlib
+import json
+import os
+import requests
+import threading
+import urllib
+from requests.adapters import HTTPAdapter
+
+"""
+ReHeatSession keeps a single authenticated keystone (v2.0) session per
+process that ReHeat and Crank share between their nova, neutron and heat
+clients.
+
+- Tokens are cached on disk (~/.reheat/tokens.json) and reused until they
+  are about to expire, so repeated runs skip the keystone round trip. A
+  cached token keystone no longer accepts (revoked, password changed) is
+  dropped and replaced on the first 401
+- The service catalog of the cached token provides the client endpoints
+- One pooled keep-alive HTTP session is shared for direct REST calls
+
+It also provides paginating iterators over nova and neutron listings so
+large projects are neither truncated by api page limits nor materialized
+in a single response.
+
+# Dependancies
+sudo pip install requests
+"""
+
+__author__ = "Mika Ayenson"
+__copyright__ = "The Johns Hopkins APL"
+__credits__ = ["N/A"]
+__version__ = "1.0.0"
+__maintainer__ = "Mika Ayenson"
+__email__ = "mika.ayenson@jhuapl.edu"
+__status__ = "Strictly POC Development"
+
+
+# one session per set of credentials for the whole process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# records requested per page from nova and neutron
+PAGE_SIZE = 500
+
+
+def get_session(auth_url, username, password, tenant_name, region_name=None):
+    """ return the process wide session for these credentials """
+
+    key = (auth_url, username, tenant_name, region_name)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = ReHeatSession(auth_url, username, password, tenant_name, region_name)
+        return _sessions[key]
+
+
+def paginate(list_page, page_size=PAGE_SIZE):
+    """ yield records page by page, list_page(limit, marker) returns one page
+
+        paging stops on an empty page only: the api caps limit at its own
+        osapi_max_limit, so a short page does not mean the listing is done
+    """
+
+    marker = None
+    while True:
+        page = list_page(page_size, marker)
+        if len(page) == 0:
+            return
+        for item in page:
+            yield item
+        marker = page[-1]["id"] if isinstance(page[-1], dict) else page[-1].id
+
+
+def list_servers(novaclient, page_size=PAGE_SIZE, **search_opts):
+    """ page through novaclient.servers.list() with limit/marker """
+
+    def list_page(limit, marker):
+        opts = dict(search_opts, limit=limit, marker=marker)
+        return novaclient.servers.list(search_opts=opts)
+    return paginate(list_page, page_size)
+
+
+def list_images(novaclient, page_size=PAGE_SIZE, detailed=True):
+    """ page through the nova image listing with limit/marker
+
+        novaclient 2.15's public ImageManager.list() takes a limit but no
+        marker, so it can only ever return the first page. Its _list() is
+        the manager's own request helper (list() is a thin wrapper around
+        it) and is the only way to pass a marker with this client version
+    """
+
+    path = "/images/detail" if detailed else "/images"
+
+    def list_page(limit, marker):
+        query = {"limit": limit}
+        if marker is not None:
+            query["marker"] = marker
+        return novaclient.images._list("%s?%s" % (path, urllib.urlencode(query)), "images")
+    return paginate(list_page, page_size)
+
+
+def list_neutron(list_call, collection, page_size=PAGE_SIZE, **params):
+    """ yield the records of a neutronclient list_* call page by page,
+        following the next links neutron returns when pagination is enabled
+    """
+
+    for page in list_call(retrieve_all=False, limit=page_size, **params):
+        for item in page[collection]:
+            yield item
+
+
+class ReHeatSession:
+
+    def __init__(self, auth_url, username, password, tenant_name, region_name=None):
+        # credential variables
+        self.auth_url          = auth_url
+        self.username          = username
+        self.password          = password
+        self.tenant_name       = tenant_name
+        self.region_name       = region_name
+
+        # token cache variables
+        self.cache_file        = os.path.join(os.path.expanduser("~"), ".reheat", "tokens.json")
+        self.expiry_margin     = datetime.timedelta(minutes=5)
+        self.access            = None
+        self.cached            = False
+        self.lock              = threading.Lock()
+
+        # pooled keep-alive connections
+        self.pool_size         = 16
+        self.http              = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    @property
+    def auth_token(self):
+        return self.authenticate()["token"]["id"]
+
+    @property
+    def tenant_id(self):
+        return self.authenticate()["token"]["tenant"]["id"]
+
+    def authenticate(self):
+        """ return a valid access block, from memory, disk or keystone """
+
+        with self.lock:
+            if self.is_expired(self.access):
+                self.access = self.load_cache()
+                self.cached = True
+            if self.is_expired(self.access):
+                self.access = self.request_token()
+                self.cached = False
+                self.save_cache()
+            return self.access
+
+    def invalidate(self):
+        """ forget the current token, in memory and on disk """
+
+        with self.lock:
+            self.access = None
+            cache = self.read_cache()
+            if cache.pop(self.cache_key(), None) is not None:
+                self.write_cache(cache)
+
+    def verify(self):
+        """ make sure a token taken from the cache is still accepted before
+            the clients are handed it
+        """
+
+        self.authenticate()
+        if self.cached:
+            self.request("GET", "%s/flavors" % self.url_for("compute").rstrip("/"), params={"limit": 1})
+
+    def request(self, method, url, **kwargs):
+        """ an authenticated call over the pooled session; on a 401 the token
+            is dropped, a new one requested and the call retried once
+        """
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["X-Auth-Token"] = self.auth_token
+        r = self.http.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401:
+            self.invalidate()
+            headers["X-Auth-Token"] = self.auth_token
+            r = self.http.request(method, url, headers=headers, **kwargs)
+        return r
+
+    def url_for(self, service_type, endpoint_type="publicURL"):
+        """ look up a service endpoint in the catalog of the current token """
+
+        for service in self.authenticate()["serviceCatalog"]:
+            if service["type"] != service_type:
+                continue
+            for endpoint in service["endpoints"]:
+                if self.region_name is None or endpoint.get("region") == self.region_name:
+                    return endpoint[endpoint_type]
+        raise LookupError("No %s endpoint found for %s" % (endpoint_type, service_type))
+
+    def request_token(self):
+        """ authenticate against keystone with username and password """
+
+        body = {"auth": {"tenantName": self.tenant_name,
+                         "passwordCredentials": {"username": self.username,
+                                                 "password": self.password}}}
+        r = self.http.post("%s/tokens" % self.auth_url.rstrip("/"),
+                           data=json.dumps(body),
+                           headers={"Content-Type": "application/json"})
+        r.raise_for_status()
+        return r.json()["access"]
+
+    def is_expired(self, access):
+        """ treat tokens that expire within expiry_margin as expired """
+
+        if access is None:
+            return True
+        try:
+            expires = datetime.datetime.strptime(access["token"]["expires"][:19], "%Y-%m-%dT%H:%M:%S")
+        except (KeyError, ValueError):
+            return True
+        return expires - self.expiry_margin <= datetime.datetime.utcnow()
+
+    def cache_key(self):
+        """ tokens are cached per endpoint, user, tenant and region. The
+            password is left out, a token keystone rejects after it changed
+            is dropped on the first 401
+        """
+
+        return hashlib.sha1("%s|%s|%s|%s" % (self.auth_url, self.username,
+                                             self.tenant_name, self.region_name)).hexdigest()
+
+    def load_cache(self):
+        return self.read_cache().get(self.cache_key())
+
+    def save_cache(self):
+        # drop expired tokens of other credentials while we are at it
+        cache = dict((key, access) for key, access in self.read_cache().items() if not self.is_expired(access))
+        cache[self.cache_key()] = self.access
+        self.write_cache(cache)
+
+    def read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_cache(self, cache):
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            # the mode of open only applies to new files
+            os.fchmod(fd, 0600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+        except (IOError, OSError) as e:
+            print "\t! Could not write token cache %s: %s" % (self.cache_file, str(e))
@@ -1,7 +1,6 @@
 import argparse
 import base64
 import ConfigParser
-import datetime
 import json
 import MySQLdb
 import os
@@ -14,6 +13,12 @@ import yaml
 from contextlib import contextmanager
 from os import environ as env
 
+# emit yaml with libyaml when it is available
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 """
 ReHeatWeb is a standalone program that can generate stack templates.
 It also has the capability of returning nova network tologies as a template.
@@ -60,16 +65,19 @@ class ReHeatWeb:
         # heat variables
         self.template_type     = args.template_type
         self.heat_template     = None
-        self.heat_filename     = "heat_template.yaml"
+        self.template_format   = args.format
+        self.heat_filename     = "heat_template.%s" % self.template_format
         self.heatclient        = None
 
         # nova and neutron variables
         self.compute_template  = None
-        self.compute_filename  = "compute_template.yaml"
+        self.compute_yaml      = None
+        self.compute_filename  = "compute_template.%s" % self.template_format
         self.novaclient        = None
         self.neutronclient     = None
         self.compute_data      = {}
         self.filtered_networks = []
+        self.all_servers       = []
 
         # user cred variables
         self.username          = None
@@ -79,6 +87,8 @@ class ReHeatWeb:
         self.region_name       = None
         self.db_name           = "nova"
         self.db_pass           = "notnova"
+        self.userdata          = {}
+        self.userdata_chunk    = 500
 
         # snapshoting variables
         self.snap_threashold   = 20
@@ -90,10 +100,13 @@ class ReHeatWeb:
         self.set_of_images     = None
         self.set_of_flavors    = None
         self.set_of_keys       = []
-        self.all_nets          = []
+        self.image_params      = {}
+        self.flavor_params     = {}
+        self.key_params        = {}
         self.floating_ips      = []
         self.tenant_routers    = []
         self.all_ports         = []
+        self.ports_by_device   = {}
         self.cmdline           = False
         self.staticips         = args.staticips
         self.request           = args.webrequest
@@ -122,9 +135,8 @@ class ReHeatWeb:
         print "\t* Generating combined nova and neutron data"
         self.init_compute_clients()
         self.compute_data["heat_template_version"] = "2013-05-23"
-        self.compute_data["description"] = "Generated Template %s on Project %s" % \
-            (str(datetime.datetime.now().strftime("%A, %d. %B %Y %I:%M%p")),
-             str(self.tenant_name))
+        # no timestamp, an unchanged project gives a byte identical template
+        self.compute_data["description"] = "Generated Template on Project %s" % str(self.tenant_name)
         self.compute_data["parameters"] = {}
         self.compute_data["resources"] = {}
         self.gen_parameters()
@@ -153,7 +165,8 @@ class ReHeatWeb:
 
         print "\t* Adding parameters to compute template"
         # get all the server client
-        servers = self.novaclient.server_list(self.request)[0]
+        self.all_servers = self.list_servers()
+        servers = self.all_servers
 
         # add all key_pair_names
         self.gen_key_name_parameters()
@@ -167,17 +180,35 @@ class ReHeatWeb:
         # add all networks
         self.gen_network_parameters()
 
+    def list_servers(self):
+        """ page through all the servers of the project; a single server_list
+            call is silently truncated at the api page size
+        """
+
+        servers = []
+        marker = None
+        while True:
+            page, has_more = self.novaclient.server_list(self.request,
+                                                         search_opts={'paginate': True,
+                                                                      'marker': marker})
+            servers.extend(page)
+            if not has_more or len(page) == 0:
+                return servers
+            marker = page[-1].id
+
     def gen_key_name_parameters(self):
         """ generate all the key_pair names and add them to compute_data """
 
         keys = self.novaclient.keypair_list(self.request)
-        self.set_of_keys = set(map(lambda key: key.name, keys))
+        self.set_of_keys = sorted(set(map(lambda key: key.name, keys)))
+        self.key_params = {}
         key_idx = ""
         for idx, key_pair in enumerate(self.set_of_keys):
             data = {"type": "string",
                     "description": "Name of keypair to assign to servers",
                     "default": key_pair}
             self.compute_data["parameters"]["key_name%s" % key_idx] = data
+            self.key_params[key_pair] = "key_name%s" % key_idx
             if len(self.set_of_keys) >= 1:
                 key_idx = str(1+idx)
 
@@ -195,6 +226,9 @@ class ReHeatWeb:
         # ask user if they want snapshots of information
         self.set_of_images = []
 
+        # server id -> image parameter name
+        self.image_params = {}
+
         snapping = self.using_snapshots and (len(server_images) < self.snap_threashold)
 
         # if using snapshots:
@@ -203,7 +237,7 @@ class ReHeatWeb:
             print "\t* You have opted to generate snapshots"
             self.using_snapshots = True
             # create snapshot
-            for server in server_images:
+            for server in sorted(server_images):
                 try:
                     name = "%s_snapshot" % server[1]
                     snapshot_id = self.novaclient.snapshot_create(self.request, server[0], name)
@@ -216,11 +250,12 @@ class ReHeatWeb:
 
             # add image information to template
             image_idx = ""
-            for idx, image in enumerate(set(self.snapshot_ids)):
+            for idx, image in enumerate(sorted(set(self.snapshot_ids))):
                 data = {"type": "string",
                         "description": "Name of image to use for servers",
                         "default": image[1]}  # subtle difference
                 self.compute_data["parameters"]["image%s" % image_idx] = data
+                self.image_params[image[0]] = "image%s" % image_idx
                 if len(self.snapshot_ids) >= 1:
                     image_idx = str(1+idx)
         else:
@@ -235,28 +270,37 @@ class ReHeatWeb:
                 self.set_of_images.append(server.image_name)
 
             # add image information to template
+            image_names = {}
             image_idx = ""
-            for idx, image in enumerate(set(self.set_of_images)):
+            for idx, image in enumerate(sorted(set(self.set_of_images))):
                 data = {"type": "string",
                         "description": "Name of image to use for servers",
                         "default": image}  # subtle difference
                 self.compute_data["parameters"]["image%s" % image_idx] = data
+                image_names[image] = "image%s" % image_idx
                 if len(self.set_of_images) >= 1:
                     image_idx = str(1+idx)
 
+            for server in servers:
+                if server.image_name in image_names:
+                    self.image_params[server.id] = image_names[server.image_name]
+
     def gen_flavor_parameters(self, servers):
         """ generate all the images and add them to compute_data """
 
         # get all the flavors
         flavors = self.novaclient.flavor_list(self.request)
         server_flavors = set([x.flavor["id"] for x in servers])
-        self.set_of_flavors = set(filter(lambda flavor: flavor.id in server_flavors, flavors))
+        self.set_of_flavors = sorted(set(filter(lambda flavor: flavor.id in server_flavors, flavors)),
+                                     key=lambda flavor: flavor.id)
+        self.flavor_params = {}
         flavor_idx = ""
         for idx, flavor in enumerate(self.set_of_flavors):
             data = {"type": "string",
                     "description": "Flavor to use for servers",
                     "default": flavor.name}
             self.compute_data["parameters"]["flavor%s" % flavor_idx] = data
+            self.flavor_params[flavor.id] = "flavor%s" % flavor_idx
             if len(self.set_of_flavors) >= 1:
                 flavor_idx = str(1+idx)
 
@@ -267,10 +311,12 @@ class ReHeatWeb:
 
         # add all the routers
         all_routers = self.neutronclient.router_list(self.request)
-        self.tenant_routers = filter(lambda router: router['tenant_id'] == self.tenant_id, all_routers)
+        self.tenant_routers = sorted(filter(lambda router: router['tenant_id'] == self.tenant_id, all_routers),
+                                     key=lambda router: router['id'])
 
         # add all the ports
         self.all_ports = self.neutronclient.port_list(self.request)
+        self.gen_port_index()
 
         for idx, router in enumerate(self.tenant_routers):
 
@@ -284,7 +330,7 @@ class ReHeatWeb:
             except:
                 print "\t! Could not add external_gateway_info for %s" % router["name"]
 
-        networks = self.neutronclient.network_list(self.request)
+        networks = sorted(self.neutronclient.network_list(self.request), key=lambda net: net['id'])
 
         # filter all networks that match
         self.filtered_networks = [net for net in networks if (net["tenant_id"] == self.tenant_id or
@@ -334,6 +380,15 @@ class ReHeatWeb:
                     self.compute_data["parameters"]["shared_net_%s" % str(shared_net_id)] = data
                     shared_net_id += 1
 
+    def gen_port_index(self):
+        """ index all the ports by device so routers and servers can find
+            their ports without rescanning the full port list
+        """
+
+        self.ports_by_device = {}
+        for port in self.all_ports:
+            self.ports_by_device.setdefault(port["device_id"], []).append(port)
+
     def gen_resources(self):
         """ Generate all the resources """
 
@@ -359,9 +414,6 @@ class ReHeatWeb:
 
                 for subnet_info in network["subnets"]:
 
-                    # save this information for router interfaces
-                    self.all_nets.append((subnet_info, "%s" % network["name"], "%s" % subnet_info["name"]))
-
                     # generate private net
                     data = {"type": "OS::Neutron::Net",
                             "properties":
@@ -385,10 +437,6 @@ class ReHeatWeb:
                         }
                     self.compute_data["resources"]["%s" % network["name"]] = data
                     self.compute_data["resources"]["%s" % subnet_info["name"]] = data2
-            else:
-                # add shared network to the full list of networks
-                for subnet_info in network["subnets"]:
-                    self.all_nets.append((subnet_info, "%s" % network["name"], "%s" % subnet_info["name"]))
 
     def gen_router_resources(self):
         """ Generate all the router resources """
@@ -399,10 +447,7 @@ class ReHeatWeb:
         year = version.version_string()
 
         for idx, router in enumerate(self.tenant_routers):
-            router_ports = []
-            for port in self.all_ports:
-                router_ports = [port for port in self.all_ports if router["id"]
-                                == port["device_id"]]
+            router_ports = self.ports_by_device.get(router["id"], [])
 
             # add the router definition
             if "2013" in year:
@@ -488,40 +533,34 @@ class ReHeatWeb:
         """ Generate all the instance resources """
         print "\t* Adding server resources to compute template"
         # add all instances
-        servers = self.novaclient.server_list(self.request)[0]
+        servers = self.all_servers
 
         # add all ports
         ports = []
 
         self.set_of_images = set(self.set_of_images)
 
+        # pull the user_data of every server up front
+        try:
+            self.userdata = self.gen_userdata_map([server.id for server in servers])
+        except Exception as e:
+            print "\t! Could not obtain userdata information: %s" % str(e)
+            self.userdata = {}
+
         for server in servers:
 
-            if self.using_snapshots:
-                # get template image id
-                images = [(idx, x[1]) for idx, x in enumerate(set(self.snapshot_ids)) if x[0] == server.name]
-            else:
-                # get template image id
-                images = [(idx, x) for idx, x in enumerate(self.set_of_images) if x == server.image_name]
+            # get template image id (snapshot or base image)
+            image_ = self.image_params.get(server.id)
 
             # continue to next iteration.
-            if len(images) == 0:
+            if image_ is None:
                 continue
-            image_num = images[0][0] if images[0][0] > 0 else ""
-            image_ = "image%s" % image_num
 
             # get template flavor id
-            flavors = [(idx, x) for idx, x in enumerate(self.set_of_flavors) if x.id == server.flavor["id"]]
-            flavor_num = flavors[0][0] if flavors[0][0] > 0 else ""
-            flavor_ = "flavor%s" % flavor_num
+            flavor_ = self.flavor_params[server.flavor["id"]]
 
             # get template keys
-            keys = [(idx, x) for idx, x in enumerate(self.set_of_keys) if x == server.key_name]
-            try:
-                key_num = keys[0][0] if keys[0][0] > 0 else ""
-            except Exception:
-                key_num = ""
-            key_ = "key_name%s" % key_num
+            key_ = self.key_params.get(server.key_name, "key_name")
 
             # get template network info
             networks_ = []
@@ -581,11 +620,35 @@ class ReHeatWeb:
         if (self.SuppressServerStatuses is False):
             print "\t* Generating userdata information if available"
 
+        return self.userdata.get(uuid, ("case1", None))
+
+    def gen_userdata_map(self, uuids):
+        """ Pull the user_data of all the given servers over one connection
+            with batched, parameterized queries. Returns uuid -> (case, payload)
+        """
+
+        userdata = {}
         db = MySQLdb.connect(host="localhost", user=self.db_name, passwd=self.db_pass, db=self.db_name)
-        cursor = db.cursor()
-        cursor.execute("SELECT user_data from instances where uuid='%s'" % (uuid,))
         try:
-            user_data = cursor.fetchone()[0]
+            cursor = db.cursor()
+            for idx in range(0, len(uuids), self.userdata_chunk):
+                chunk = uuids[idx:idx + self.userdata_chunk]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute("SELECT uuid, user_data from instances where uuid IN (%s)" % placeholders, chunk)
+                for uuid, user_data in cursor.fetchall():
+                    userdata[uuid] = self.decode_userdata(user_data)
+                    if self.template_format == "json" and not self.is_text(userdata[uuid][1]):
+                        # yaml writes it as !!binary, json only carries text
+                        print "\t! user_data of server %s is not UTF-8 text, leaving it out of the json template" % uuid
+                        userdata[uuid] = ("case1", None)
+        finally:
+            db.close()
+        return userdata
+
+    def decode_userdata(self, user_data):
+        """ Decode a raw user_data column and split the cloud-init MIME payload """
+
+        try:
             searching_for = 'filename="cfn-userdata"'
             if user_data is not None:
                 decoded = base64.decodestring(user_data)
@@ -601,14 +664,23 @@ class ReHeatWeb:
                     # with user_data in cloud init
                     return ("case2", cloud_userdata)
                 # with user_data only
-                return ("case3", base64.decodestring(user_data))
+                return ("case3", decoded)
             else:
                 return("case1", None)
         except Exception as e:
             print "Exception in userdata capture: \n", str(e)
-            return None
-        db.commit()
-        db.close()
+            return ("case1", None)
+
+    def is_text(self, payload):
+        """ whether a decoded user_data payload is UTF-8 text """
+
+        if payload is None:
+            return True
+        try:
+            payload.decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return True
 
     def gen_port_resources(self, server, ports):
         """ 
@@ -680,13 +752,14 @@ class ReHeatWeb:
         """ Generate a yaml file of the nova and neutron data """
 
         print "\t* Generating compute template in file %s" % self.compute_filename
+        self.compute_yaml = self.serialize(self.compute_template)
         if self.cmdline:
             with open(self.compute_filename, 'w') as f:
-                f.write(yaml.safe_dump(self.compute_template))
+                f.write(self.compute_yaml)
 
             try:
-                self.heatclient.template_validate(self.webrequest,
-                                                  template=yaml.safe_dump(self.compute_template))
+                self.heatclient.template_validate(self.request,
+                                                  template=self.compute_yaml)
             except Exception as e:
                 print "Unfortunately your file is malformed. Received error: (%s)" % str(e)
                 print "Exiting ..."
@@ -694,6 +767,15 @@ class ReHeatWeb:
 
         return self.compute_template
 
+    def serialize(self, template):
+        """ dump a template (yaml or json) a single time so the same bytes
+            can be written, validated and returned
+        """
+
+        if self.template_format == "json":
+            return json.dumps(template, sort_keys=True)
+        return yaml.dump(template, Dumper=SafeDumper)
+
     @contextmanager
     def suppress(self):
         """ used to suppress some of the function outputs from printing to screen """
@@ -713,6 +795,8 @@ def main():
                          all], (default: all)', required=True)
     parser.add_argument('--snapshots', default=False, action='store_true',
                         help='If set, create snapshots')
+    parser.add_argument('--format', default='yaml', choices=['yaml', 'json'],
+                        help='template output format [yaml, json], (default: yaml)')
     parser.add_argument('--staticips', default=False, action='store_true',
                         help='If set, set static ips')
     parser.add_argument('--webtenant', default=None, dest="webtenant",
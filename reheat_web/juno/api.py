@@ -12,7 +12,6 @@
 
 import argparse
 import json
-import yaml
 from ReHeatWeb import ReHeatWeb
 from openstack_dashboard.api import heat
 
@@ -23,18 +22,20 @@ from openstack_dashboard.dashboards.project.stacks import sro
 class Stack(object):
     pass
 
-def reheat_data(clientrequest, clientapi):
+def reheat_data(clientrequest, clientapi, template_format='yaml'):
     args = argparse.Namespace()
     args.template_type = 'compute'  # generate all new template data from neutron and nova
+    args.format = template_format  # yaml or json
     args.snapshots = False  # do not snapshot each image when reheating
     args.staticips = False  # by default save old ip information
     args.webtenant = clientrequest.session.get('token', '').tenant["name"]  #  current project name
     args.webapi = clientapi
     args.webrequest = clientrequest
     rh = ReHeatWeb(args)
-    data = rh.run()
+    rh.run()
 
-    return yaml.safe_dump(data)
+    # the template has already been serialized once by ReHeatWeb
+    return rh.compute_yaml
 
 def d3_data(request, stack_id=''):
     try:
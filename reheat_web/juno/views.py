@@ -17,7 +17,9 @@ from operator import attrgetter
 from django.core.urlresolvers import reverse
 from django.core.urlresolvers import reverse_lazy
 from django.http import HttpResponse  # noqa
+from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.gzip import gzip_page
 import django.views.generic
 
 from horizon import exceptions
@@ -268,9 +270,16 @@ class JSONView(django.views.generic.View):
 
 
 class ReHeatView(django.views.generic.View):
+    # templates of large projects compress well, gzip them for browsers
+    # that accept it
+    @method_decorator(gzip_page)
     def get(self, request):
         try:
-            return HttpResponse(project_api.reheat_data(request, api), content_type="application/json")
+            template_format = request.GET.get('format', 'yaml')
+            if template_format not in ('yaml', 'json'):
+                template_format = 'yaml'
+            return HttpResponse(project_api.reheat_data(request, api, template_format),
+                                content_type="application/json")
         except Exception as e:
             msg = _("Unable to ReHeat." + str(e))
             redirect = reverse('horizon:project:stacks:index')